@@ -3,5 +3,14 @@ set -e
 
 uv run init_settings
 
+# One mailer for the whole container, the API workers do not poll. It exits
+# with an error if its loop dies, restart it.
+(
+    while true; do
+        uv run mail_daemon || echo "mail_daemon exited with status $?, restarting" >&2
+        sleep 5
+    done
+) &
+
 exec uv run gunicorn -w 4 -k uvicorn.workers.UvicornWorker \
     shared_planner.api:app --bind 0.0.0.0:8000
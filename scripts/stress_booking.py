@@ -0,0 +1,146 @@
+"""Fire N parallel bookings at one slot and check that exactly its capacity succeed
+
+Each booking runs in its own process, like requests spread over API workers,
+and they all start together. Runs against a throwaway SQLite database unless
+a DATABASE_URL is given (e.g. the `postgres` compose profile):
+
+    uv run python scripts/stress_booking.py -n 40 --capacity 5
+    uv run python scripts/stress_booking.py --database-url postgresql+psycopg://...
+
+Exits with status 1 if the slot was overbooked or underbooked.
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+
+def setup(bookings: int, capacity: int) -> tuple[int, int, datetime.date, list[int]]:
+    """Create a shop with one slot of `capacity` and one user per booking"""
+    from shared_planner.db.models import Shop, TimeSlot, User
+    from shared_planner.db.session import SessionLock
+    from shared_planner.db.settings import init_settings
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        init_settings()
+
+    today = datetime.date.today()
+    date = today + datetime.timedelta(days=7)
+    run = time.time_ns()
+    with SessionLock() as session:
+        shop = Shop(
+            name=f"Stress {run}",
+            location="",
+            maps_link="",
+            description="",
+            min_time=0,
+            max_time=24 * 60,
+            available_from=datetime.datetime.combine(today, datetime.time()),
+            available_until=datetime.datetime.combine(date, datetime.time()),
+        )
+        users = [
+            User(
+                full_name=f"Stress {i}", email=f"stress-{run}-{i}@example.com", group=""
+            )
+            for i in range(bookings)
+        ]
+        session.add(shop)
+        session.add_all(users)
+        session.flush()
+        slot = TimeSlot(
+            shop_id=shop.id,
+            day=date.weekday(),
+            start_time=datetime.time(10),
+            end_time=datetime.time(12),
+            max_volunteers=capacity,
+            valid_from=today,
+            valid_until=date,
+        )
+        session.add(slot)
+        session.commit()
+        return shop.id, slot.id, date, [user.id for user in users]
+
+
+def book(
+    shop_id: int, slot_id: int, date: datetime.date, user_id: int, barrier
+) -> tuple[str, float]:
+    """Outcome of one booking and how long it took once every booker was ready"""
+    from fastapi import HTTPException
+
+    from shared_planner.api.reservations import BookMultipleSlotsRequest, book_slots
+    from shared_planner.db.models import User
+    from shared_planner.db.session import SessionLock
+
+    with SessionLock() as session:
+        user = session.get(User, user_id)
+    request = BookMultipleSlotsRequest(time_slot_ids=[slot_id], date=date)
+    barrier.wait()
+    start = time.monotonic()
+    try:
+        book_slots(shop_id, request, user)
+    except HTTPException as e:
+        return e.detail, time.monotonic() - start
+    return "ok", time.monotonic() - start
+
+
+def check(shop_id: int, slot_id: int, date: datetime.date) -> tuple[int, int]:
+    """Reservations of the shop and occupancy counter of the slot, from the database"""
+    from sqlmodel import func, select
+
+    from shared_planner.db.models import Reservation, SlotOccupancy
+    from shared_planner.db.session import SessionLock
+
+    with SessionLock() as session:
+        reservations = session.exec(
+            select(func.count()).where(Reservation.shop_id == shop_id)
+        ).one()
+        occupancy = session.get(SlotOccupancy, (slot_id, date))
+    return reservations, occupancy.booked if occupancy is not None else 0
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("-n", "--bookings", type=int, default=40)
+    parser.add_argument("--capacity", type=int, default=5)
+    parser.add_argument("--database-url")
+    args = parser.parse_args()
+
+    if args.database_url is None:
+        directory = tempfile.mkdtemp()
+        args.database_url = f"sqlite:///{os.path.join(directory, 'stress.db')}"
+    # Read by shared_planner.db.session in this process and in the bookers
+    os.environ["DATABASE_URL"] = args.database_url
+
+    shop_id, slot_id, date, user_ids = setup(args.bookings, args.capacity)
+
+    context = multiprocessing.get_context("spawn")  # No engine shared with a fork
+    with context.Manager() as manager, context.Pool(args.bookings) as pool:
+        barrier = manager.Barrier(args.bookings)
+        results = pool.starmap(
+            book,
+            [(shop_id, slot_id, date, user_id, barrier) for user_id in user_ids],
+        )
+
+    outcomes = Counter(outcome for outcome, _ in results)
+    elapsed = max(duration for _, duration in results)
+    reservations, booked = check(shop_id, slot_id, date)
+    print(f"{args.bookings} bookings in {elapsed:.2f}s: {dict(outcomes)}")
+    print(f"reservations: {reservations}, occupancy counter: {booked}")
+    if not outcomes["ok"] == reservations == booked == args.capacity:
+        print(f"FAILED: expected exactly {args.capacity} bookings")
+        sys.exit(1)
+    print("OK")
+
+
+if __name__ == "__main__":
+    main()
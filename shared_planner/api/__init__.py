@@ -1,8 +1,7 @@
 import os
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
-from starlette.responses import FileResponse
 from contextlib import asynccontextmanager
 
 from shared_planner.api.auth import router as auth_router
@@ -12,17 +11,30 @@ from shared_planner.api.slots import router as slots_router
 from shared_planner.api.reservations import router as reservations_router
 from shared_planner.api.settings import router as settings_router
 from shared_planner.api.notifications import router as notifications_router
+from shared_planner.api.events import router as events_router
+from shared_planner.api.calendar import router as calendar_router
+from shared_planner.events import broker
 from shared_planner.mailer_daemon import start_mailer_daemon, stop_mailer_daemon
+from shared_planner.static import manifest
 from pathlib import Path
 
 
+# Production runs a single `mail_daemon` process next to the API workers
+EMBEDDED_MAILER = os.getenv("EMBEDDED_MAILER", "false").lower() in ("true", "1", "yes")
+
+
 @asynccontextmanager
-async def mailer_daemon_context(app: FastAPI):
-    start_mailer_daemon()
+async def lifespan(app: FastAPI):
+    manifest.load(BASE_DIR)
+    broker.start()
+    if EMBEDDED_MAILER:
+        start_mailer_daemon()
     try:
         yield
     finally:
-        stop_mailer_daemon()
+        if EMBEDDED_MAILER:
+            stop_mailer_daemon()
+        await broker.stop()
 
 
 app = FastAPI(
@@ -30,7 +42,7 @@ app = FastAPI(
     root_path="/api",
     title="Shared Planner API",
     version="1.0",
-    lifespan=mailer_daemon_context,
+    lifespan=lifespan,
 )
 
 BASE_DIR = Path(__file__).resolve().parent.parent.parent / "web" / "dist"
@@ -51,19 +63,13 @@ app.include_router(slots_router)
 app.include_router(reservations_router)
 app.include_router(settings_router)
 app.include_router(notifications_router)
-
-
-def sanitize_path(path: str) -> str:
-    return os.path.normpath(path).replace("..", "")
+app.include_router(events_router)
+app.include_router(calendar_router)
 
 
 @app.get("/{rest_of_path:path}")
-def serve_my_app(rest_of_path: str):
-    rest_of_path = sanitize_path(rest_of_path)
-
-    if rest_of_path == "" or rest_of_path == "/" or rest_of_path == ".":
-        return FileResponse(BASE_DIR / "index.html")
-
-    if (BASE_DIR / rest_of_path).exists():
-        return FileResponse(BASE_DIR / rest_of_path)
-    return FileResponse(BASE_DIR / "index.html")
+def serve_my_app(rest_of_path: str, request: Request):
+    asset = manifest.find(rest_of_path)
+    if asset is None:
+        raise HTTPException(status_code=404, detail="error.frontend.not_built")
+    return asset.response(request)
@@ -1,12 +1,23 @@
+import datetime
+import os
 import re
-from typing import Annotated
+from typing import Annotated, NamedTuple
 
-from fastapi import APIRouter, Depends, Form, HTTPException
+from fastapi import APIRouter, Depends, Form, HTTPException, Query
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from pydantic import BaseModel
-from sqlmodel import select
-
-from shared_planner.db.models import Notification, PasswordReset, Token, User
+from sqlalchemy.orm import make_transient_to_detached
+from sqlmodel import SQLModel, delete, select, update
+
+from shared_planner.cache import TTLCache
+from shared_planner.db.models import (
+    PRINCIPALS_VERSION_KEY,
+    Counter,
+    Notification,
+    PasswordReset,
+    Token,
+    User,
+)
 from shared_planner.db.session import SessionLock
 from shared_planner.db.settings import get
 from shared_planner.mailer_daemon import send_mail
@@ -15,6 +26,14 @@ router = APIRouter(prefix="/auth", tags=["auth"])
 
 _oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 
+# Time (in seconds) a resolved token is kept in memory while no user or token changes
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", 30))
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", 4096))
+# The expiry of a token is pushed back at most once per interval
+TOKEN_RENEW_INTERVAL = datetime.timedelta(
+    minutes=int(os.getenv("TOKEN_RENEW_INTERVAL_MINUTES", 5))
+)
+
 
 class UserResult(BaseModel):
     """Data model for getting a user profile"""
@@ -38,45 +57,98 @@ class UserResult(BaseModel):
         )
 
 
-def CurrentToken(access_token: Annotated[str, Depends(_oauth2_scheme)]) -> Token:
-    """Get the current token from the access token"""
+class _Principal(NamedTuple):
+    """Column values of a token and of its user
+
+    `version` is the PRINCIPALS_VERSION_KEY counter read before loading them:
+    the entry is only used while the counter keeps this value, so users and
+    tokens changed by any worker are read again on the next request.
+    """
+
+    token: dict
+    user: dict
+    version: int
+
+
+_principals: TTLCache[str, _Principal] = TTLCache(
+    PRINCIPAL_CACHE_SIZE, PRINCIPAL_CACHE_TTL
+)
+
+
+def _snapshot(instance: SQLModel) -> dict:
+    return {
+        column.name: getattr(instance, column.name)
+        for column in instance.__table__.columns
+    }
+
+
+def _detached(model: type[SQLModel], values: dict) -> SQLModel:
+    """Build a fresh instance that sessions treat as an existing row"""
+    instance = model(**values)
+    make_transient_to_detached(instance)
+    return instance
+
+
+def forget_token(access_token: str) -> None:
+    """Drop a token from this worker's cache"""
+    _principals.pop(access_token)
+
+
+def _resolve(access_token: str) -> _Principal:
     with SessionLock() as session:
-        statement = select(Token).where(Token.access_token == access_token)
-        token = session.exec(statement).first()
+        version = Counter.read(session, PRINCIPALS_VERSION_KEY)
+        principal = _principals.get(access_token)
+        if principal is None or principal.version != version:
+            statement = select(Token).where(Token.access_token == access_token)
+            token = session.exec(statement).first()
+
+            if token is None:
+                forget_token(access_token)
+                raise HTTPException(status_code=401, detail="error.token.invalid")
+
+            principal = _Principal(_snapshot(token), _snapshot(token.user), version)
+            _principals.set(access_token, principal)
+
+    token: Token = _detached(Token, principal.token)
+    if token.is_expired():
+        forget_token(access_token)
+        with SessionLock() as session:
+            session.exec(delete(Token).where(Token.id == token.id))
+            session.commit()
+        raise HTTPException(status_code=401, detail="error.token.expired")
+
+    # Sliding expiry: only write when the token was not renewed recently
+    previous_expiry = token.expires_at
+    token.renew()
+    if token.expires_at - previous_expiry >= TOKEN_RENEW_INTERVAL:
+        with SessionLock() as session:
+            session.exec(
+                update(Token)
+                .where(Token.id == token.id)
+                .values(expires_at=token.expires_at)
+            )
+            session.commit()
+        principal = principal._replace(
+            token={**principal.token, "expires_at": token.expires_at}
+        )
+        _principals.set(access_token, principal)
 
-        if token is None:
-            raise HTTPException(status_code=401, detail="error.token.invalid")
+    return principal
 
-        if token.is_expired():
-            session.delete(token)
-            raise HTTPException(status_code=401, detail="error.token.expired")
 
-        token.renew()
-        session.add(token)
-        session.commit()
-        session.refresh(token)
-    return token
+def CurrentToken(access_token: Annotated[str, Depends(_oauth2_scheme)]) -> Token:
+    """Get the current token from the access token"""
+    return _detached(Token, _resolve(access_token).token)
 
 
 def CurrentUser(access_token: Annotated[str, Depends(_oauth2_scheme)]) -> User:
     """Get the current user from the access token"""
-    with SessionLock() as session:
-        statement = select(Token).where(Token.access_token == access_token)
-        token = session.exec(statement).first()
+    return _detached(User, _resolve(access_token).user)
 
-        if token is None:
-            raise HTTPException(status_code=401, detail="error.token.invalid")
 
-        if token.is_expired():
-            session.delete(token)
-            raise HTTPException(status_code=401, detail="error.token.expired")
-
-        token.renew()
-        session.add(token)
-        session.commit()
-        session.refresh(token)
-        user = token.user
-    return user
+def CurrentUserFromQuery(token: Annotated[str, Query()]) -> User:
+    """Get the current user from the `token` query parameter (for EventSource)"""
+    return _detached(User, _resolve(token).user)
 
 
 def CurrentAdmin(user: Annotated[User, Depends(CurrentUser)]) -> User:
@@ -196,8 +268,9 @@ def register(
 @router.post("/logout")
 def logout(token: Annotated[Token, Depends(CurrentToken)]) -> str:
     with SessionLock() as session:
-        token = session.get(Token, token.id)
-        session.delete(token)
+        session.exec(delete(Token).where(Token.id == token.id))
+        Counter.bump(session, PRINCIPALS_VERSION_KEY)
         session.commit()
+    forget_token(token.access_token)
 
     return "Logged out"
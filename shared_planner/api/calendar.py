@@ -0,0 +1,192 @@
+import datetime
+import os
+import secrets
+from collections.abc import Iterator
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, HTTPException, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlmodel import select
+
+from shared_planner.api.auth import CurrentUser
+from shared_planner.db.models import (
+    CALENDAR_KEY_PREFIX,
+    Counter,
+    Reservation,
+    Shop,
+    User,
+)
+from shared_planner.db.session import SessionLock
+from shared_planner.ics import feed_event, stream_feed
+
+FEED_CHUNK_SIZE = int(os.getenv("FEED_CHUNK_SIZE", 500))
+
+router = APIRouter(prefix="/calendar", tags=["calendar"])
+
+
+def _feed_user(session: SessionLock, calendar_token: str) -> User:
+    user = session.exec(
+        select(User).where(User.calendar_token == calendar_token)
+    ).first()
+    if user is None:
+        raise HTTPException(status_code=404, detail="error.calendar.not_found")
+    return user
+
+
+def _versions(session: SessionLock, *keys: str) -> tuple[str, int]:
+    """ETag and last change (ms) of a feed from its CALENDAR_KEY_PREFIX counters"""
+    keys = [f"{CALENDAR_KEY_PREFIX}{key}" for key in keys]
+    values = dict(
+        session.exec(
+            select(Counter.key, Counter.value).where(Counter.key.in_(keys))
+        ).all()
+    )
+    versions = [values.get(key, 0) for key in keys]
+    return f'"{"-".join(map(str, versions))}"', max(versions)
+
+
+def _not_modified(request: Request, etag: str, changed_at: int) -> bool:
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return etag in tags or "*" in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since is None or changed_at == 0:
+        return False
+    try:
+        since = parsedate_to_datetime(if_modified_since)
+    except (TypeError, ValueError):
+        return False
+    return changed_at // 1000 <= since.timestamp()
+
+
+def _feed_response(
+    request: Request, etag: str, changed_at: int, name: str, events: Iterator[str]
+) -> Response:
+    """Answer 304 when the client is up to date, else stream the feed"""
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+    if changed_at:
+        headers["Last-Modified"] = format_datetime(
+            datetime.datetime.fromtimestamp(changed_at // 1000, datetime.timezone.utc),
+            usegmt=True,
+        )
+    if _not_modified(request, etag, changed_at):
+        events.close()
+        return Response(status_code=304, headers=headers)
+    return StreamingResponse(
+        stream_feed(name, events),
+        media_type="text/calendar; charset=utf-8",
+        headers=headers,
+    )
+
+
+def _stamp() -> str:
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def _user_events(user_id: int) -> Iterator[str]:
+    stamp = _stamp()
+    with SessionLock() as session:
+        result = session.exec(
+            select(
+                Reservation.id,
+                Reservation.start_time,
+                Reservation.end_time,
+                Shop.name,
+                Shop.maps_link,
+            )
+            .join(Shop, Reservation.shop_id == Shop.id)
+            .where(Reservation.user_id == user_id)
+            .order_by(Reservation.start_time)
+            .execution_options(yield_per=FEED_CHUNK_SIZE)
+        )
+        for rows in result.partitions():
+            yield "".join(
+                feed_event(
+                    id,
+                    f"Réservation chez {shop_name}",
+                    start_time,
+                    end_time,
+                    f"Réservation chez {shop_name}\nCliquer pour ouvrir dans Google Maps : {maps_link}",
+                    maps_link,
+                    stamp,
+                )
+                for id, start_time, end_time, shop_name, maps_link in rows
+            )
+
+
+def _shop_events(shop_id: int) -> Iterator[str]:
+    stamp = _stamp()
+    with SessionLock() as session:
+        result = session.exec(
+            select(
+                Reservation.id,
+                Reservation.start_time,
+                Reservation.end_time,
+                User.full_name,
+                Shop.maps_link,
+            )
+            .join(User, Reservation.user_id == User.id)
+            .join(Shop, Reservation.shop_id == Shop.id)
+            .where(Reservation.shop_id == shop_id)
+            .order_by(Reservation.start_time)
+            .execution_options(yield_per=FEED_CHUNK_SIZE)
+        )
+        for rows in result.partitions():
+            yield "".join(
+                feed_event(id, full_name, start_time, end_time, "", maps_link, stamp)
+                for id, start_time, end_time, full_name, maps_link in rows
+            )
+
+
+@router.get("/token")
+def get_calendar_token(user: Annotated[User, Depends(CurrentUser)]) -> str:
+    """Secret of the user's calendar subscription URLs, created on first use"""
+    with SessionLock() as session:
+        db_user = session.get(User, user.id)
+        if db_user.calendar_token is None:
+            db_user.calendar_token = secrets.token_urlsafe(24)
+            session.add(db_user)
+            session.commit()
+        token = db_user.calendar_token
+    return token
+
+
+@router.post("/token/reset")
+def reset_calendar_token(user: Annotated[User, Depends(CurrentUser)]) -> str:
+    """Replace the secret, the previous subscription URLs stop working"""
+    with SessionLock() as session:
+        db_user = session.get(User, user.id)
+        db_user.calendar_token = secrets.token_urlsafe(24)
+        session.add(db_user)
+        session.commit()
+        token = db_user.calendar_token
+    return token
+
+
+@router.get("/{calendar_token}/reservations.ics")
+def user_feed(calendar_token: str, request: Request) -> Response:
+    """Calendar subscription (webcal) of the user's reservations"""
+    with SessionLock() as session:
+        user = _feed_user(session, calendar_token)
+        etag, changed_at = _versions(session, f"user:{user.id}", "shops")
+        user_id = user.id
+    return _feed_response(
+        request, etag, changed_at, "Mes réservations", _user_events(user_id)
+    )
+
+
+@router.get("/{calendar_token}/shop/{shop_id}.ics")
+def shop_feed(calendar_token: str, shop_id: int, request: Request) -> Response:
+    """Calendar subscription (webcal) of every reservation of a shop, for admins"""
+    with SessionLock() as session:
+        user = _feed_user(session, calendar_token)
+        if not user.admin:
+            raise HTTPException(status_code=403, detail="error.admin.required")
+        shop = session.get(Shop, shop_id)
+        if shop is None:
+            raise HTTPException(status_code=404, detail="error.shop.not_found")
+        etag, changed_at = _versions(session, f"shop:{shop_id}", "shops")
+        name = shop.name
+    return _feed_response(request, etag, changed_at, name, _shop_events(shop_id))
@@ -0,0 +1,80 @@
+import asyncio
+import json
+from typing import Annotated
+
+from fastapi import APIRouter, Depends, Query
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
+
+from shared_planner.api.auth import CurrentUserFromQuery
+from shared_planner.db.models import Event, Notification, User
+from shared_planner.db.session import SessionLock
+from shared_planner.events import broker, last_event_id
+
+KEEPALIVE_INTERVAL = 15  # Seconds, proxies close idle connections
+RECONNECT_DELAY = 3000  # Milliseconds, sent to the client
+
+router = APIRouter(prefix="/events", tags=["events"])
+
+
+def _message(type: str, data: str) -> str:
+    return f"event: {type}\ndata: {data}\n\n"
+
+
+def _unread_count(user: User) -> int:
+    with SessionLock() as session:
+        return Notification.count_unread(user, session)
+
+
+def _last_event_id() -> int:
+    with SessionLock() as session:
+        return last_event_id(session)
+
+
+@router.get("")
+async def events(
+    user: Annotated[User, Depends(CurrentUserFromQuery)],
+    shop_id: Annotated[list[int], Query()] = [],
+) -> StreamingResponse:
+    """Server-Sent Events stream of the changes relevant to the user
+
+    - `unread`: `{"count": n}` on connection and whenever it changes
+    - `booked`: `{"slot_id", "date", "booked_count"}` for the `shop_id` shops
+    """
+    channels = [Event.user_channel(user.id)]
+    if user.admin:
+        channels.append(Event.user_channel(None))
+    channels += [f"shop:{id}" for id in shop_id]
+
+    # Mark before the count: a change committed in between is delivered too,
+    # and the count is read again for each unread event, so none is missed
+    since = await run_in_threadpool(_last_event_id)
+    count = await run_in_threadpool(_unread_count, user)
+    subscription = broker.subscribe(channels, since)
+
+    async def stream():
+        try:
+            yield f"retry: {RECONNECT_DELAY}\n\n"
+            yield _message("unread", json.dumps({"count": count}))
+            while not subscription.lagging:
+                try:
+                    type, data = await asyncio.wait_for(
+                        subscription.queue.get(), KEEPALIVE_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    yield ": keepalive\n\n"
+                    continue
+                if type == "unread":
+                    # Events may come twice or late, the count is always right
+                    unread = await run_in_threadpool(_unread_count, user)
+                    data = json.dumps({"count": unread})
+                yield _message(type, data)
+            # Closing makes the client reconnect and start from a fresh state
+        finally:
+            broker.unsubscribe(subscription)
+
+    return StreamingResponse(
+        stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
@@ -1,15 +1,71 @@
-from fastapi import APIRouter, Depends, HTTPException
+import datetime
+import os
+from typing import Annotated, Literal
+
+from fastapi import APIRouter, Depends, HTTPException, Query
+from pydantic import BaseModel, Field
 from sqlalchemy import select
-from sqlmodel import delete
 
 
 from shared_planner.api.auth import CurrentUser
-from shared_planner.db.models import Notification, User
+from shared_planner.db.models import Notification, NotificationRead, User
 from shared_planner.db.session import SessionLock
 
+NOTIFICATION_PAGE_SIZE = int(os.getenv("NOTIFICATION_PAGE_SIZE", 100))
+NOTIFICATION_MAX_PAGE_SIZE = int(os.getenv("NOTIFICATION_MAX_PAGE_SIZE", 500))
+
 router = APIRouter(prefix="/notifications", tags=["notifications"])
 
 
+class Page:
+    """Cursor over notifications sorted newest first
+
+    The next page starts after the date and id of the last notification.
+    """
+
+    def __init__(
+        self,
+        before_date: datetime.datetime | None = None,
+        before_id: int | None = None,
+        limit: Annotated[
+            int, Query(gt=0, le=NOTIFICATION_MAX_PAGE_SIZE)
+        ] = NOTIFICATION_PAGE_SIZE,
+    ):
+        self.before_date = before_date
+        self.before_id = before_id
+        self.limit = limit
+
+    def args(self) -> dict:
+        return {
+            "before_date": self.before_date,
+            "before_id": self.before_id,
+            "limit": self.limit,
+        }
+
+
+class BulkResult(BaseModel):
+    """Number of notifications changed, and the first page if requested"""
+
+    count: int
+    notifications: list[Notification] | None = None
+
+    @staticmethod
+    def build(
+        session: SessionLock, user: User, count: int, include_page: bool, page: Page
+    ) -> "BulkResult":
+        notifications = None
+        if include_page:
+            notifications = Notification.list_notifications(
+                user, session, **page.args()
+            )
+        return BulkResult(count=count, notifications=notifications)
+
+
+class BatchRequest(BaseModel):
+    ids: list[int] = Field(max_length=NOTIFICATION_MAX_PAGE_SIZE)
+    action: Literal["read", "unread", "delete"]
+
+
 @router.get("/count")
 def count_notifications(user: User = Depends(CurrentUser)) -> int:
     with SessionLock() as session:
@@ -18,24 +74,20 @@ def count_notifications(user: User = Depends(CurrentUser)) -> int:
 
 
 @router.get("/list")
-def list_notifications(user: User = Depends(CurrentUser)) -> list[Notification]:
+def list_notifications(
+    user: User = Depends(CurrentUser), page: Page = Depends()
+) -> list[Notification]:
     with SessionLock() as session:
-        user = session.get(User, user.id)
-        if user is None:
-            raise HTTPException(404, "error.auth.user_not_found")
-
-        if not user.admin:
-            notifications = user.notifications
-        else:
-            # A bit more expensive, but we need to get the admin notifications too
-            notifications = Notification.list_notifications(user, session)
+        notifications = Notification.list_notifications(user, session, **page.args())
     return notifications
 
 
 @router.get("/unread")
-def list_unread(user: User = Depends(CurrentUser)) -> list[Notification]:
+def list_unread(
+    user: User = Depends(CurrentUser), page: Page = Depends()
+) -> list[Notification]:
     with SessionLock() as session:
-        notifications = Notification.find_unread(user, session)
+        notifications = Notification.find_unread(user, session, **page.args())
     return notifications
 
 
@@ -55,33 +107,41 @@ def delete_notification(notification_id: int, user: User = Depends(CurrentUser))
 
 
 @router.delete("/all")
-def delete_all_notifications(user: User = Depends(CurrentUser)):
+def delete_all_notifications(
+    user: User = Depends(CurrentUser),
+    include_page: bool = False,
+    page: Page = Depends(),
+) -> BulkResult:
     with SessionLock() as session:
-        session.exec(delete(Notification).where(Notification.user_id == user.id))
+        count = Notification.delete_many(session, user)
         session.commit()
-        result = list_notifications(user)
-    return result
-
+        return BulkResult.build(session, user, count, include_page, page)
 
-@router.patch("/id/{notification_id}/read")
-def mark_read(notification_id: int, user: User = Depends(CurrentUser)):
-    with SessionLock() as session:
-        notification = session.get(Notification, notification_id)
-        if notification is None:
-            raise HTTPException(404, "error.notification.not_found")
 
-        if notification.user_id != user.id and not user.admin:
-            raise HTTPException(403, "error.notification.not_allowed")
+@router.post("/batch")
+def batch_notifications(
+    request: BatchRequest,
+    user: User = Depends(CurrentUser),
+    include_page: bool = False,
+    page: Page = Depends(),
+) -> BulkResult:
+    """Read, unread or delete several notifications of the user's inbox at once
 
-        notification.mark_read()
-        session.add(notification)
+    Ids of notifications outside the inbox are ignored.
+    """
+    ids = list(set(request.ids))
+    with SessionLock() as session:
+        if request.action == "delete":
+            count = Notification.delete_many(session, user, ids)
+        else:
+            count = Notification.set_read_many(
+                session, user, request.action == "read", ids
+            )
         session.commit()
-        session.refresh(notification)
-    return notification
+        return BulkResult.build(session, user, count, include_page, page)
 
 
-@router.patch("/id/{notification_id}/unread")
-def mark_unread(notification_id: int, user: User = Depends(CurrentUser)):
+def _set_read(notification_id: int, user: User, read: bool) -> Notification:
     with SessionLock() as session:
         notification = session.get(Notification, notification_id)
         if notification is None:
@@ -90,25 +150,43 @@ def mark_unread(notification_id: int, user: User = Depends(CurrentUser)):
         if notification.user_id != user.id and not user.admin:
             raise HTTPException(403, "error.notification.not_allowed")
 
-        notification.mark_unread()
+        if notification.user_id is None:
+            # Admin notifications are read or unread for this admin only
+            if read:
+                NotificationRead.mark(session, user.id, [notification.id])
+            else:
+                NotificationRead.unmark(session, user.id, [notification.id])
+            session.commit()
+            session.refresh(notification)
+            return notification.model_copy(update={"read": read})
+
+        if read:
+            notification.mark_read()
+        else:
+            notification.mark_unread()
         session.add(notification)
         session.commit()
         session.refresh(notification)
     return notification
 
 
-@router.patch("/all/read")
-def mark_all_read(user: User = Depends(CurrentUser)):
-    with SessionLock() as session:
-        notifications: list[Notification] = Notification.find_unread(user, session)
-        for notification in notifications:
-            notification.mark_read()
-            session.add(notification)
+@router.patch("/id/{notification_id}/read")
+def mark_read(notification_id: int, user: User = Depends(CurrentUser)):
+    return _set_read(notification_id, user, True)
 
-        session.commit()
-        for notification in notifications:
-            session.refresh(notification)
 
-        notifications = Notification.list_notifications(user, session)
+@router.patch("/id/{notification_id}/unread")
+def mark_unread(notification_id: int, user: User = Depends(CurrentUser)):
+    return _set_read(notification_id, user, False)
+
 
-    return notifications
+@router.patch("/all/read")
+def mark_all_read(
+    user: User = Depends(CurrentUser),
+    include_page: bool = False,
+    page: Page = Depends(),
+) -> BulkResult:
+    with SessionLock() as session:
+        count = Notification.set_read_many(session, user, True)
+        session.commit()
+        return BulkResult.build(session, user, count, include_page, page)
@@ -1,10 +1,12 @@
 import datetime
+import os
 
 from typing import Annotated
-from fastapi import APIRouter, Body, Depends, HTTPException
+from fastapi import APIRouter, Body, Depends, HTTPException, Query, Request
 from fastapi.responses import StreamingResponse
 from pydantic import BaseModel
-from sqlmodel import select
+from sqlalchemy.orm import joinedload
+from sqlmodel import and_, or_, select, true
 
 from shared_planner.api.auth import CurrentAdmin, CurrentUser, CurrentToken
 from shared_planner.api.shops import ShopWithoutTimeRanges
@@ -12,8 +14,21 @@ from shared_planner.api.slots import TimeSlotOut
 from shared_planner.db.models import Reservation, Shop, TimeSlot, User, Token, Notification
 from shared_planner.db.session import SessionLock
 from shared_planner.db.settings import get
+from shared_planner.export import stream_csv, stream_parquet
+from shared_planner.planning import (
+    booked_count,
+    load_day,
+    load_week,
+    occupy,
+    release,
+    slot_bounds,
+)
+from shared_planner.versions import cached_json
 from shared_planner.week import monday_str
 
+SEARCH_PAGE_SIZE = int(os.getenv("SEARCH_PAGE_SIZE", 200))
+SEARCH_MAX_PAGE_SIZE = int(os.getenv("SEARCH_MAX_PAGE_SIZE", 1000))
+
 router = APIRouter(prefix="/res", tags=["reservations"])
 
 
@@ -39,8 +54,12 @@ class ReservedTimeRange(BaseModel):
 
     @classmethod
     def from_reservation(
-        cls, reservation: Reservation, user: User | None
+        cls,
+        reservation: Reservation,
+        user: User | None,
+        shop: ShopWithoutTimeRanges | None = None,
     ) -> "ReservedTimeRange":
+        """`shop` can be given to reuse the shop data between reservations"""
         if user is not None and reservation.user_id == user.id:
             status = -2
             title = "message.reservation.booked_by_you"
@@ -61,7 +80,7 @@ class ReservedTimeRange(BaseModel):
             status=status,
             validated=reservation.validated,
             title=title,
-            shop=ShopWithoutTimeRanges.from_shop(reservation.shop),
+            shop=shop or ShopWithoutTimeRanges.from_shop(reservation.shop),
         )
 
 
@@ -88,72 +107,54 @@ class BookMultipleSlotsRequest(BaseModel):
 
 @router.get("/{shop_id}/{monday}/list")
 def get_planning(
-    shop_id: int, monday: str, user: Annotated[User, Depends(CurrentUser)]
+    shop_id: int,
+    monday: str,
+    user: Annotated[User, Depends(CurrentUser)],
+    request: Request,
 ) -> list[list[SlotStatus]]:
     """Get the slot planning of a shop for a specific week"""
-    with SessionLock() as session:
-        shop = session.get(Shop, shop_id)
-        if shop is None:
-            raise HTTPException(status_code=404, detail="error.shop.not_found")
-
-        week_start = datetime.datetime.strptime(monday, "%Y-%m-%d")
-        if week_start.weekday() != 0:
-            raise HTTPException(status_code=400, detail="error.reservation.not_monday")
-
-        week_end = week_start + datetime.timedelta(days=7)
-        # Fetch all reservations for this shop in this week
-        week_reservations = session.exec(
-            select(Reservation).where(
-                Reservation.shop_id == shop_id,
-                Reservation.start_time >= week_start,
-                Reservation.start_time < week_end,
-            )
-        ).all()
-
-        result = []
-        for day_offset in range(7):
-            day_date = (week_start + datetime.timedelta(days=day_offset)).date()
-            weekday = day_date.weekday()
-
-            day_slots = [
-                s
-                for s in shop.time_slots
-                if s.day == weekday and s.valid_from <= day_date <= s.valid_until
-            ]
-            day_slots.sort(key=lambda s: s.start_time)
-
-            day_statuses = []
-            for slot in day_slots:
-                # Find reservations that overlap with this slot
-                slot_start = datetime.datetime.combine(day_date, slot.start_time)
-                slot_end = datetime.datetime.combine(day_date, slot.end_time)
-
-                slot_reservations = [
-                    r
-                    for r in week_reservations
-                    if (r.start_time < slot_end and r.end_time > slot_start)
-                ]
-
-                booked_count = len(slot_reservations)
-                my_res = next(
-                    (r for r in slot_reservations if r.user_id == user.id), None
-                )
-
-                day_statuses.append(
-                    SlotStatus(
-                        slot=TimeSlotOut.from_slot(slot),
-                        date=day_date,
-                        booked_count=booked_count,
-                        booked_by_me=my_res is not None,
-                        reservation_id=my_res.id if my_res else None,
-                        validated=my_res.validated if my_res else False,
+    week_start = datetime.datetime.strptime(monday, "%Y-%m-%d")
+    if week_start.weekday() != 0:
+        raise HTTPException(status_code=400, detail="error.reservation.not_monday")
+    week = week_start.date().isoformat()
+
+    def build() -> list[list[SlotStatus]]:
+        with SessionLock() as session:
+            shop = session.get(Shop, shop_id)
+            if shop is None:
+                raise HTTPException(status_code=404, detail="error.shop.not_found")
+
+            planning = load_week(session, shop_id, week_start, user.id)
+
+            result = []
+            for day_date, day_slots in planning.days():
+                day_statuses = []
+                for slot in day_slots:
+                    slot_start, slot_end = slot_bounds(slot, day_date)
+                    my_res = planning.index.find(user.id, slot_start, slot_end)
+
+                    day_statuses.append(
+                        SlotStatus(
+                            slot=TimeSlotOut.from_slot(slot),
+                            date=day_date,
+                            booked_count=planning.booked(slot, day_date),
+                            booked_by_me=my_res is not None,
+                            reservation_id=my_res.id if my_res else None,
+                            validated=my_res.validated if my_res else False,
+                        )
                     )
-                )
 
-            result.append(day_statuses)
-        session.close()
+                result.append(day_statuses)
+        return result
 
-    return result
+    # booked_by_me depends on the user
+    return cached_json(
+        request,
+        ("planning", shop_id, week, user.id),
+        [f"shop:{shop_id}", f"slots:{shop_id}", f"week:{shop_id}:{week}"],
+        list[list[SlotStatus]],
+        build,
+    )
 
 
 @router.post("/{shop_id}/book")
@@ -207,24 +208,19 @@ def book_slots(
             raise HTTPException(status_code=400, detail="error.reservation.after_close")
 
         # Verification for each slot
+        own_reservations = load_day(session, shop_id, req.date, user.id)
         for slot in slots:
-            slot_start = datetime.datetime.combine(req.date, slot.start_time)
-            slot_end = datetime.datetime.combine(req.date, slot.end_time)
-
-            # Use overlap check for existing reservations
-            query = select(Reservation).where(
-                Reservation.shop_id == shop_id,
-                Reservation.start_time < slot_end,
-                Reservation.end_time > slot_start,
-            )
-            existing = session.exec(query).all()
+            slot_start, slot_end = slot_bounds(slot, req.date)
 
-            if any(r.user_id == user.id for r in existing):
+            if own_reservations.find(user.id, slot_start, slot_end) is not None:
                 raise HTTPException(
                     status_code=400, detail="error.reservation.already_booked"
                 )
 
-            if len(existing) >= slot.max_volunteers and not user.admin:
+            if (
+                booked_count(session, slot, req.date) >= slot.max_volunteers
+                and not user.admin
+            ):
                 raise HTTPException(status_code=400, detail="error.reservation.overlap")
 
         overall_start = datetime.datetime.combine(req.date, slots[0].start_time)
@@ -286,6 +282,8 @@ def book_slots(
             )
 
         session.add(new_reservation)
+        # The checks above are only a fast path, this is what enforces capacity
+        occupy(session, new_reservation, [] if user.admin else slots)
         session.commit()
         session.refresh(new_reservation)
 
@@ -351,6 +349,7 @@ def cancel_reservation(
                     mail=get("email_admin_reservation_cancelled").asBool(),
                 )
             )
+        release(session, reservation)
         session.delete(reservation)
         session.commit()
     return None
@@ -371,45 +370,67 @@ def validate_reservation(reservation_id: int) -> ReservedTimeRange:
     return result
 
 
-@router.get("/list_self")
-def get_user_reservations(
-    token: Annotated[Token, Depends(CurrentToken)],
+def _after(after_start_time: datetime.datetime | None, after_id: int | None):
+    """Keyset condition selecting reservations after a (start_time, id) cursor"""
+    if after_start_time is None or after_id is None:
+        return true()
+    return or_(
+        Reservation.start_time > after_start_time,
+        and_(Reservation.start_time == after_start_time, Reservation.id > after_id),
+    )
+
+
+def _page(session: SessionLock, query, user: User | None) -> list[ReservedTimeRange]:
+    """Run a reservation query, loading each shop once"""
+    shops: dict[int, ShopWithoutTimeRanges] = {}
+    result = []
+    for res in session.exec(query.options(joinedload(Reservation.shop))):
+        if res.shop_id not in shops:
+            shops[res.shop_id] = ShopWithoutTimeRanges.from_shop(res.shop)
+        result.append(ReservedTimeRange.from_reservation(res, user, shops[res.shop_id]))
+    return result
+
+
+def _user_reservations(
+    token: Token,
+    future: bool,
+    after_start_time: datetime.datetime | None,
+    after_id: int | None,
+    limit: int,
 ) -> list[ReservedTimeRange]:
-    """Get the reservations of the current user"""
     with SessionLock() as session:
         user = session.get(User, token.user_id)
         if user is None:
             raise HTTPException(status_code=404, detail="error.user.not_found")
-        reservations = sorted(
-            [
-                ReservedTimeRange.from_reservation(res, user)
-                for res in user.reservations
-            ],
-            key=lambda res: res.start_time,
+        query = select(Reservation).where(
+            Reservation.user_id == user.id, _after(after_start_time, after_id)
         )
-    return reservations
+        if future:
+            query = query.where(Reservation.end_time > datetime.datetime.now())
+        query = query.order_by(Reservation.start_time, Reservation.id).limit(limit)
+        return _page(session, query, user)
+
+
+@router.get("/list_self")
+def get_user_reservations(
+    token: Annotated[Token, Depends(CurrentToken)],
+    after_start_time: datetime.datetime | None = None,
+    after_id: int | None = None,
+    limit: Annotated[int, Query(gt=0, le=SEARCH_MAX_PAGE_SIZE)] = SEARCH_PAGE_SIZE,
+) -> list[ReservedTimeRange]:
+    """Get the reservations of the current user, paginated like /search"""
+    return _user_reservations(token, False, after_start_time, after_id, limit)
 
 
 @router.get("/list_self_future")
 def get_user_future_reservations(
     token: Annotated[Token, Depends(CurrentToken)],
+    after_start_time: datetime.datetime | None = None,
+    after_id: int | None = None,
+    limit: Annotated[int, Query(gt=0, le=SEARCH_MAX_PAGE_SIZE)] = SEARCH_PAGE_SIZE,
 ) -> list[ReservedTimeRange]:
-    """Get the future reservations of the current user"""
-    with SessionLock() as session:
-        user = session.get(User, token.user_id)
-        if user is None:
-            raise HTTPException(status_code=404, detail="error.user.not_found")
-        reservations = sorted(
-            [
-                ReservedTimeRange.from_reservation(res, user)
-                for res in filter(
-                    lambda res: res.end_time > datetime.datetime.now(),
-                    user.reservations,
-                )
-            ],
-            key=lambda res: res.start_time,
-        )
-    return reservations
+    """Get the future reservations of the current user, paginated like /search"""
+    return _user_reservations(token, True, after_start_time, after_id, limit)
 
 
 @router.post("/search", dependencies=[Depends(CurrentAdmin)])
@@ -417,10 +438,20 @@ def search(
     shop_id: int | None = Body(None),
     user_id: int | None = Body(None),
     monday: str | None = Body(None),
+    start: datetime.date | None = Body(None),
+    end: datetime.date | None = Body(None),
+    after_start_time: datetime.datetime | None = Body(None),
+    after_id: int | None = Body(None),
+    limit: int = Body(SEARCH_PAGE_SIZE, gt=0, le=SEARCH_MAX_PAGE_SIZE),
 ) -> list[ReservedTimeRange]:
-    """Search reservations by shop, user, and/or week."""
+    """Search reservations by shop, user, week and/or date range.
+
+    Results are sorted by start time and paginated: pass the start time and id
+    of the last reservation of a page as `after_start_time` and `after_id` to
+    get the next one. A page shorter than `limit` is the last one.
+    """
     with SessionLock() as session:
-        query = select(Reservation)
+        query = select(Reservation).options(joinedload(Reservation.user))
         if shop_id is not None:
             query = query.where(Reservation.shop_id == shop_id)
         if user_id is not None:
@@ -431,8 +462,24 @@ def search(
             query = query.where(
                 Reservation.start_time >= week_start, Reservation.start_time < week_end
             )
-        reservations = session.exec(query)
-        result = [ReservedTimeRange.from_reservation(res, None) for res in reservations]
+        if start is not None:
+            query = query.where(
+                Reservation.start_time
+                >= datetime.datetime.combine(start, datetime.time())
+            )
+        if end is not None:
+            query = query.where(
+                Reservation.start_time
+                < datetime.datetime.combine(
+                    end + datetime.timedelta(days=1), datetime.time()
+                )
+            )
+        query = (
+            query.where(_after(after_start_time, after_id))
+            .order_by(Reservation.start_time, Reservation.id)
+            .limit(limit)
+        )
+        result = _page(session, query, None)
     return result
 
 
@@ -497,53 +544,31 @@ def reassign_reservation(
     return result
 
 
-@router.get("/all_data/{api_key}")
-def get_all_data(api_key: str) -> str:
-    """Export all reservations as CSV"""
+def _check_api_key(api_key: str) -> None:
     if get("api_key").value == "":
         raise HTTPException(status_code=403, detail="error.api_key_not_set")
     if api_key != get("api_key").value:
         raise HTTPException(status_code=403, detail="error.api_key_invalid")
 
-    import csv
-    from io import StringIO
 
-    output = StringIO()
-
-    with SessionLock() as session:
-        query = (
-            select(Reservation)
-            .order_by(Reservation.start_time)
-            .order_by(Reservation.shop_id)
-        )
-        reservations = session.exec(query)
-        writer = csv.DictWriter(
-            output,
-            fieldnames=[
-                "shop_name",
-                "user_name",
-                "user_email",
-                "user_group",
-                "user_admin",
-                "start_time",
-                "duration",
-            ],
-        )
-        writer.writeheader()
-        for res in reservations:
-            writer.writerow(
-                {
-                    "shop_name": res.shop.name,
-                    "user_name": res.user.full_name,
-                    "user_email": res.user.email,
-                    "user_group": res.user.group,
-                    "user_admin": res.user.admin,
-                    "start_time": res.start_time,
-                    "duration": (res.end_time - res.start_time).total_seconds()
-                    / (60 * 60),
-                }
-            )
-    value = output.getvalue()
-    output.close()
-    response = StreamingResponse(content=iter([value]), media_type="text/csv")
-    return response
+@router.get("/all_data/{api_key}")
+def get_all_data(api_key: str) -> str:
+    """Export all reservations as CSV"""
+    _check_api_key(api_key)
+    return StreamingResponse(content=stream_csv(), media_type="text/csv")
+
+
+@router.get("/all_data/{api_key}/parquet")
+def get_all_data_parquet(
+    api_key: str,
+    start: datetime.date | None = None,
+    end: datetime.date | None = None,
+    shop_id: int | None = None,
+) -> bytes:
+    """Export reservations with their user, shop and time slot as Parquet"""
+    _check_api_key(api_key)
+    return StreamingResponse(
+        content=stream_parquet(start, end, shop_id),
+        media_type="application/vnd.apache.parquet",
+        headers={"Content-Disposition": 'attachment; filename="reservations.parquet"'},
+    )
@@ -1,13 +1,25 @@
 import datetime
 
 from fastapi import APIRouter, Body, Depends, HTTPException
-from sqlalchemy import delete, select
+from sqlalchemy import delete
 from sqlmodel import or_
 
 from shared_planner.api.auth import CurrentAdmin, CurrentUser
-from shared_planner.db.models import Notification, PasswordReset, User, Token, Setting
+from shared_planner.db.models import (
+    MailOutbox,
+    Notification,
+    PasswordReset,
+    User,
+    Token,
+    Setting,
+)
 from shared_planner.db.session import SessionLock
-from shared_planner.db.settings import get as get_setting
+from shared_planner.db.settings import (
+    cache as settings_cache,
+    get as get_setting,
+    notify_changed,
+)
+from shared_planner.events import purge_events
 
 router = APIRouter(prefix="/settings", tags=["settings"])
 
@@ -21,31 +33,30 @@ def patch(name: str, value: str = Body(...)) -> Setting:
 
         setting.value = value
         session.add(setting)
+        notify_changed(session)
         session.commit()
         session.refresh(setting)
+
+    settings_cache.invalidate()
     return setting
 
 
 @router.get("/s/{name}")
 def get(name: str, user: User = Depends(CurrentUser)) -> Setting:
-    with SessionLock() as session:
-        setting = session.get(Setting, name)
-        if setting is None:
-            raise HTTPException(404, "error.admin.setting_not_found")
+    try:
+        setting = get_setting(name)
+    except ValueError:
+        raise HTTPException(404, "error.admin.setting_not_found")
 
-        if setting.private and not user.admin:
-            raise HTTPException(403, "error.admin.required")
+    if setting.private and not user.admin:
+        raise HTTPException(403, "error.admin.required")
 
     return setting
 
 
 @router.get("/s/", dependencies=[Depends(CurrentAdmin)])
 def list_settings() -> list[Setting]:
-    with SessionLock() as session:
-        statement = select(Setting)
-        settings = session.exec(statement).scalars().all()
-
-    return settings
+    return settings_cache.all()
 
 
 @router.post("/cleanup_db", dependencies=[Depends(CurrentAdmin)])
@@ -65,13 +76,15 @@ def cleanup_db():
 
         result_password_reset = session.exec(query)
 
-        result_reminders = None
-        result_notifications = None
-        result_notifications_admin = None
+        deleted_reminders = 0
+        deleted_notifications = 0
+        deleted_notifications_admin = 0
+        result_mails = None
 
         # Clear expired reminders
         if get_setting("cleanup_reminders_days").asInt() != -1:
-            query = delete(Notification).where(
+            deleted_reminders = Notification.delete_where(
+                session,
                 Notification.date
                 < datetime.datetime.now()
                 - datetime.timedelta(
@@ -79,10 +92,10 @@ def cleanup_db():
                 ),
                 Notification.is_reminder == True,  # noqa: E712
             )
-            result_reminders = session.exec(query)
 
         if get_setting("cleanup_notifications_days").asInt() != -1:
-            query = delete(Notification).where(
+            deleted_notifications = Notification.delete_where(
+                session,
                 Notification.date
                 < datetime.datetime.now()
                 - datetime.timedelta(
@@ -90,10 +103,10 @@ def cleanup_db():
                 ),
                 Notification.user_id != None,  # noqa: E711
             )
-            result_notifications = session.exec(query)
 
         if get_setting("cleanup_notifications_days_admin").asInt() != -1:
-            query = delete(Notification).where(
+            deleted_notifications_admin = Notification.delete_where(
+                session,
                 Notification.date
                 < datetime.datetime.now()
                 - datetime.timedelta(
@@ -101,18 +114,31 @@ def cleanup_db():
                 ),
                 Notification.user_id == None,  # noqa: E711
             )
-            result_notifications_admin = session.exec(query)
 
+        # Clear delivered mails
+        if get_setting("cleanup_notifications_days").asInt() != -1:
+            query = delete(MailOutbox).where(
+                MailOutbox.status == "sent",
+                MailOutbox.sent_at
+                < datetime.datetime.now()
+                - datetime.timedelta(
+                    days=get_setting("cleanup_notifications_days").asInt()
+                ),
+            )
+            result_mails = session.exec(query)
+
+        # Clear the events already delivered to the live clients
+        deleted_events = purge_events(session)
+
+        Notification.recount_unread(session)
         session.commit()
     return {
         "message": "success",
         "deleted_tokens": result_auth_token.rowcount,
         "deleted_password_resets": result_password_reset.rowcount,
-        "deleted_reminders": result_reminders.rowcount if result_reminders else 0,
-        "deleted_notifications": result_notifications.rowcount
-        if result_notifications
-        else 0,
-        "deleted_notifications_admin": result_notifications_admin.rowcount
-        if result_notifications_admin
-        else 0,
+        "deleted_reminders": deleted_reminders,
+        "deleted_notifications": deleted_notifications,
+        "deleted_notifications_admin": deleted_notifications_admin,
+        "deleted_mails": result_mails.rowcount if result_mails else 0,
+        "deleted_events": deleted_events,
     }
@@ -1,12 +1,13 @@
 import datetime
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from pydantic import BaseModel
 from sqlmodel import select
 
 from shared_planner.api.auth import CurrentAdmin, CurrentToken
 from shared_planner.db.models import OpeningTime, Shop
 from shared_planner.db.session import SessionLock
+from shared_planner.versions import cached_json
 
 router = APIRouter(prefix="/shops", tags=["shops"])
 timerange_router = APIRouter(prefix="/timeranges", tags=["timeranges"])
@@ -78,24 +79,37 @@ class TimeRange(BaseModel):
 
 
 @router.get("/{shop_id}/get", dependencies=[Depends(CurrentToken)])
-def get_shop(shop_id: int) -> ShopWithTimeRanges:
+def get_shop(shop_id: int, request: Request) -> ShopWithTimeRanges:
     """Get a specific shop"""
-    with SessionLock() as session:
-        shop = session.get(Shop, shop_id)
-        if shop is None:
-            raise HTTPException(status_code=404, detail="error.shop.not_found")
 
-        result = ShopWithTimeRanges.from_shop(shop)
-    return result
+    def build() -> ShopWithTimeRanges:
+        with SessionLock() as session:
+            shop = session.get(Shop, shop_id)
+            if shop is None:
+                raise HTTPException(status_code=404, detail="error.shop.not_found")
+
+            result = ShopWithTimeRanges.from_shop(shop)
+        return result
+
+    return cached_json(
+        request, ("shop", shop_id), [f"shop:{shop_id}"], ShopWithTimeRanges, build
+    )
 
 
 @router.get("/list", dependencies=[Depends(CurrentToken)])
-def list_shops() -> list[ShopWithoutTimeRanges]:
+def list_shops(request: Request) -> list[ShopWithoutTimeRanges]:
     """List all shops"""
-    with SessionLock() as session:
-        statement = select(Shop)
-        shops = session.exec(statement).all()
-    return shops
+
+    def build() -> list[ShopWithoutTimeRanges]:
+        with SessionLock() as session:
+            statement = select(Shop)
+            shops = session.exec(statement).all()
+            result = [ShopWithoutTimeRanges.from_shop(shop) for shop in shops]
+        return result
+
+    return cached_json(
+        request, ("shops",), ["shops"], list[ShopWithoutTimeRanges], build
+    )
 
 
 @router.post("/create", dependencies=[Depends(CurrentAdmin)])
@@ -1,11 +1,13 @@
 import datetime
 
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Request
 from pydantic import BaseModel
 
 from shared_planner.api.auth import CurrentAdmin
 from shared_planner.db.models import TimeSlot, Shop
 from shared_planner.db.session import SessionLock
+from shared_planner.planning import rebuild_occupancy, release
+from shared_planner.versions import cached_json
 
 router = APIRouter(prefix="/slots", tags=["slots"])
 
@@ -44,13 +46,22 @@ class TimeSlotOut(BaseModel):
 
 
 @router.get("/{shop_id}/list")
-def list_slots(shop_id: int) -> list[TimeSlotOut]:
-    with SessionLock() as session:
-        shop = session.get(Shop, shop_id)
-        if shop is None:
-            raise HTTPException(status_code=404, detail="error.shop.not_found")
-        result = [TimeSlotOut.from_slot(s) for s in shop.time_slots]
-    return result
+def list_slots(shop_id: int, request: Request) -> list[TimeSlotOut]:
+    def build() -> list[TimeSlotOut]:
+        with SessionLock() as session:
+            shop = session.get(Shop, shop_id)
+            if shop is None:
+                raise HTTPException(status_code=404, detail="error.shop.not_found")
+            result = [TimeSlotOut.from_slot(s) for s in shop.time_slots]
+        return result
+
+    return cached_json(
+        request,
+        ("slots", shop_id),
+        [f"shop:{shop_id}", f"slots:{shop_id}"],
+        list[TimeSlotOut],
+        build,
+    )
 
 
 @router.post("/{shop_id}/create", dependencies=[Depends(CurrentAdmin)])
@@ -73,6 +84,8 @@ def create_slot(shop_id: int, slot: TimeSlotIn) -> TimeSlotOut:
             valid_until=slot.valid_until,
         )
         session.add(new_slot)
+        session.flush()
+        rebuild_occupancy(session, new_slot)
         session.commit()
         session.refresh(new_slot)
         result = TimeSlotOut.from_slot(new_slot)
@@ -96,6 +109,8 @@ def update_slot(slot_id: int, slot: TimeSlotIn) -> TimeSlotOut:
         existing.valid_from = slot.valid_from
         existing.valid_until = slot.valid_until
         session.add(existing)
+        session.flush()
+        rebuild_occupancy(session, existing)
         session.commit()
         session.refresh(existing)
         result = TimeSlotOut.from_slot(existing)
@@ -110,6 +125,7 @@ def delete_slot(slot_id: int) -> None:
             raise HTTPException(status_code=404, detail="error.slot.not_found")
         # Delete associated reservations first (no ORM cascade since FK is nullable)
         for res in list(existing.reservations):
+            release(session, res)
             session.delete(res)
         session.delete(existing)
         session.commit()
@@ -4,10 +4,16 @@ from fastapi import APIRouter, Body, Depends, HTTPException
 from pydantic import BaseModel
 from sqlmodel import select
 
-from shared_planner.api.auth import CurrentAdmin, CurrentToken, CurrentUser, UserResult
+from shared_planner.api.auth import (
+    CurrentAdmin,
+    CurrentToken,
+    CurrentUser,
+    UserResult,
+)
 from shared_planner.db.models import PasswordReset, Token, User
 from shared_planner.db.session import SessionLock
 from shared_planner.db.settings import get
+from shared_planner.planning import release
 from shared_planner.mailer_daemon import send_mail
 
 router = APIRouter(prefix="/users", tags=["users"])
@@ -130,6 +136,8 @@ def delete_user(user_id: int) -> UserResult:
         user = session.exec(statement).first()
         if user is None:
             raise HTTPException(status_code=404, detail="error.user.not_found")
+        for reservation in user.reservations:
+            release(session, reservation)
         session.delete(user)
         session.commit()
         result = UserResult.from_user(user)
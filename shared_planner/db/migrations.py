@@ -0,0 +1,258 @@
+import datetime
+import json
+from contextlib import contextmanager
+from typing import Callable, Iterator
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+from sqlalchemy import Connection, Engine, inspect, text
+from sqlmodel import SQLModel, Session, insert, select, update
+
+from shared_planner.db.models import (
+    MailOutbox,
+    Notification,
+    NotificationRead,
+    SchemaVersion,
+    TimeSlot,
+    User,
+)
+
+# Key of the PostgreSQL advisory lock held while migrating ("SPLN")
+MIGRATION_LOCK_KEY = 0x53504C4E
+
+
+def _add_reservation_time_slot(connection: Connection) -> None:
+    columns = [c["name"] for c in inspect(connection).get_columns("reservation")]
+    if "time_slot_id" not in columns:
+        connection.execute(
+            text(
+                "ALTER TABLE reservation ADD COLUMN time_slot_id INTEGER REFERENCES timeslot(id)"
+            )
+        )
+
+
+def _add_mailoutbox_digest(connection: Connection) -> None:
+    columns = [c["name"] for c in inspect(connection).get_columns("mailoutbox")]
+    if "digest" not in columns:
+        connection.execute(
+            text(
+                "ALTER TABLE mailoutbox ADD COLUMN digest BOOLEAN NOT NULL DEFAULT FALSE"
+            )
+        )
+
+
+def _add_mailoutbox_admins(connection: Connection) -> None:
+    columns = [c["name"] for c in inspect(connection).get_columns("mailoutbox")]
+    if "admins" not in columns:
+        connection.execute(
+            text(
+                "ALTER TABLE mailoutbox ADD COLUMN admins BOOLEAN NOT NULL DEFAULT FALSE"
+            )
+        )
+
+
+def _add_user_calendar_token(connection: Connection) -> None:
+    columns = [c["name"] for c in inspect(connection).get_columns("user")]
+    if "calendar_token" not in columns:
+        connection.execute(text('ALTER TABLE "user" ADD COLUMN calendar_token VARCHAR'))
+
+
+def _widen_counter_value(connection: Connection) -> None:
+    # SQLite integers are already 64 bits
+    if connection.dialect.name == "postgresql":
+        connection.execute(text("ALTER TABLE counter ALTER COLUMN value TYPE BIGINT"))
+
+
+def _add_reservation_changed_at(connection: Connection) -> None:
+    columns = [c["name"] for c in inspect(connection).get_columns("reservation")]
+    if "changed_at" not in columns:
+        connection.execute(
+            text(
+                "ALTER TABLE reservation ADD COLUMN changed_at BIGINT NOT NULL DEFAULT 0"
+            )
+        )
+
+
+def _create_indexes(*names: str) -> Callable[[Connection], None]:
+    """Migration creating indexes declared in the models on existing tables"""
+
+    def migration(connection: Connection) -> None:
+        for table in SQLModel.metadata.sorted_tables:
+            for index in table.indexes:
+                if index.name in names:
+                    index.create(connection, checkfirst=True)
+
+    migration.__name__ = f"create_indexes({', '.join(names)})"
+    return migration
+
+
+def _backfill_slot_occupancy(connection: Connection) -> None:
+    from shared_planner.planning import rebuild_occupancy  # circular import
+
+    with Session(bind=connection) as session:
+        for slot in session.exec(select(TimeSlot)).all():
+            rebuild_occupancy(session, slot)
+        session.flush()
+
+
+def _backfill_unread_counters(connection: Connection) -> None:
+    with Session(bind=connection) as session:
+        Notification.recount_unread(session)
+        session.flush()
+
+
+def _split_broadcast_read_state(connection: Connection) -> None:
+    """Admin notifications read so far stay read for every current admin"""
+    with Session(bind=connection) as session:
+        session.exec(
+            insert(NotificationRead).from_select(
+                ["notification_id", "user_id"],
+                select(Notification.id, User.id)
+                .join(User, User.admin == True)  # noqa: E712
+                .where(
+                    Notification.user_id == None,  # noqa: E711
+                    Notification.read == True,  # noqa: E712
+                ),
+            )
+        )
+        session.exec(
+            update(Notification)
+            .where(Notification.user_id == None)  # noqa: E711
+            .values(read=False)
+        )
+        Notification.recount_unread(session)
+        session.flush()
+
+
+def _queue_unsent_mails(connection: Connection) -> None:
+    """Move the mails not sent yet by the former in-memory queue to the outbox"""
+    # Only the columns that exist at this version, not the whole User model
+    with Session(bind=connection) as session:
+        admins = session.exec(
+            select(User.full_name, User.email).where(User.admin == True)  # noqa: E712
+        ).all()
+        notifications = session.exec(
+            select(
+                Notification.id,
+                Notification.user_id,
+                Notification.message,
+                Notification.data,
+                Notification.route,
+                User.full_name,
+                User.email,
+            )
+            .outerjoin(User, Notification.user_id == User.id)
+            .where(
+                Notification.mail == True,  # noqa: E712
+                Notification.mail_sent == False,  # noqa: E712
+            )
+        ).all()
+        for id, user_id, message, data, route, user_name, user_email in notifications:
+            recipients = admins if user_id is None else [(user_name, user_email)]
+            data = json.loads(data) if data else {}
+            if route:
+                data["route"] = route
+            for name, email in recipients:
+                MailOutbox.enqueue(session, name, email, message, data, id)
+        session.flush()
+
+
+# Append only: the position of a migration in this list is its version number
+MIGRATIONS: list[Callable[[Connection], None]] = [
+    _add_reservation_time_slot,
+    _create_indexes(
+        "ix_token_access_token",
+        "ix_timeslot_shop_id_day",
+        "ix_reservation_shop_id_start_time",
+    ),
+    _backfill_slot_occupancy,
+    _create_indexes("ix_reservation_user_id_end_time"),
+    _create_indexes("ix_notification_user_id_read_date"),
+    _backfill_unread_counters,
+    _split_broadcast_read_state,
+    _create_indexes("ix_reservation_reminder_sent_start_time"),
+    _queue_unsent_mails,
+    _add_mailoutbox_digest,
+    _add_mailoutbox_admins,
+    _add_user_calendar_token,
+    _create_indexes("ix_user_calendar_token"),
+    _widen_counter_value,
+    _add_reservation_changed_at,
+    _create_indexes("ix_reservation_changed_at"),
+]
+
+
+def current_version(connection: Connection) -> int:
+    with Session(bind=connection) as session:
+        versions = session.exec(select(SchemaVersion.version)).all()
+    return max(versions, default=0)
+
+
+@contextmanager
+def migration_lock(engine: Engine) -> Iterator[None]:
+    """Let a single process at a time create the tables and migrate
+
+    Every worker and node runs the migrations when it starts, the others wait
+    and then find them applied. PostgreSQL uses an advisory lock, SQLite a
+    lock file next to the database (only processes of the same host can share
+    it). In-memory databases, and SQLite on Windows, are not locked.
+    """
+    if engine.dialect.name == "postgresql":
+        with engine.connect() as connection:
+            connection.execute(
+                text("SELECT pg_advisory_lock(:key)"), {"key": MIGRATION_LOCK_KEY}
+            )
+            connection.commit()
+            try:
+                yield
+            finally:
+                connection.execute(
+                    text("SELECT pg_advisory_unlock(:key)"),
+                    {"key": MIGRATION_LOCK_KEY},
+                )
+                connection.commit()
+    elif (
+        engine.dialect.name == "sqlite"
+        and engine.url.database not in (None, "", ":memory:")
+        and fcntl is not None
+    ):
+        with open(f"{engine.url.database}.migrations.lock", "a") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+    else:
+        yield
+
+
+def run_migrations(engine: Engine) -> None:
+    """Create the missing tables and apply the pending migrations
+
+    A new database is created with the latest schema: its migrations are
+    recorded as applied without running them. Databases created before the
+    migrations were versioned run all of them (each one is idempotent).
+    Processes starting together take turns, see `migration_lock`.
+    """
+    with migration_lock(engine):
+        fresh = not inspect(engine).get_table_names()
+        SQLModel.metadata.create_all(engine)
+
+        with engine.begin() as connection:
+            version = current_version(connection)
+
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            with engine.begin() as connection:
+                if not fresh:
+                    print(f"Applying migration {number} ({migration.__name__})")
+                    migration(connection)
+                connection.execute(
+                    SchemaVersion.__table__.insert().values(
+                        version=number, applied_at=datetime.datetime.now()
+                    )
+                )
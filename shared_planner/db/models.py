@@ -2,19 +2,35 @@ import base64
 import datetime
 import hashlib
 import json
+import os
+import time
+from collections import defaultdict
 from typing import TYPE_CHECKING
 from fastapi.exceptions import HTTPException
+from sqlalchemy import (
+    BigInteger,
+    Index,
+    Select,
+    case,
+    event,
+    exists,
+    inspect,
+    union_all,
+)
+from sqlalchemy.orm import aliased, joinedload
 from sqlmodel import (
     Field,
+    Session,
     SQLModel,
     Relationship,
     func,
     not_,
     or_,
     and_,
+    delete,
+    insert,
     select,
-    true,
-    false,
+    update,
 )
 import bcrypt
 import secrets
@@ -23,6 +39,28 @@ import secrets
 if TYPE_CHECKING:
     from shared_planner.db.session import SessionLock
 
+UNREAD_KEY_PREFIX = "unread:"  # Counter keys holding unread notification counts
+# Counter keys holding the number of admin notifications read by each admin
+BROADCAST_READ_KEY_PREFIX = "broadcast_read:"
+# Counter key bumped when reservations are created, moved or cancelled
+REMINDERS_VERSION_KEY = "reminders"
+# Counter key bumped when the list of admins (or their name or email) changes
+ADMINS_VERSION_KEY = "admins"
+# Counter key bumped when users are changed or deleted, or tokens revoked
+PRINCIPALS_VERSION_KEY = "principals"
+# Counter keys holding when (in ms) reservations shown in calendar feeds changed:
+# calendar:user:<id>, calendar:shop:<id>, and calendar:shops for any shop
+CALENDAR_KEY_PREFIX = "calendar:"
+# Counter keys holding when (in ms) cached API responses last changed:
+# version:shops, version:shop:<id>, version:slots:<shop id> and
+# version:week:<shop id>:<monday> for the reservations of a shop week
+VERSION_KEY_PREFIX = "version:"
+# Reminders and admin notifications mailed to someone within this window are
+# sent together in one digest mail, from the first one of the window
+MAIL_DIGEST_WINDOW = datetime.timedelta(
+    seconds=int(os.getenv("MAIL_DIGEST_SECONDS", 300))
+)
+
 
 class User(SQLModel, table=True):
     """Represents a user in the database"""
@@ -33,6 +71,8 @@ class User(SQLModel, table=True):
     hashed_password: bytes = b""  # Password hashed
     admin: bool = False  # Is the user an admin
     group: str  # Group of the user
+    # Secret of the calendar subscription URLs, which cannot carry a login token
+    calendar_token: str | None = Field(default=None, index=True, unique=True)
     reservations: list["Reservation"] = Relationship(
         back_populates="user", cascade_delete=True
     )
@@ -40,6 +80,7 @@ class User(SQLModel, table=True):
     notifications: list["Notification"] = Relationship(
         back_populates="user", cascade_delete=True
     )
+    notification_reads: list["NotificationRead"] = Relationship(cascade_delete=True)
 
     def set_password(self, password: str):
         salt = bcrypt.gensalt()
@@ -95,10 +136,15 @@ class OpeningTime(SQLModel, table=True):
 class TimeSlot(SQLModel, table=True):
     """Recurring time slot for a shop (day-of-week based, with validity period)"""
 
+    __table_args__ = (Index("ix_timeslot_shop_id_day", "shop_id", "day"),)
+
     id: int = Field(primary_key=True, default=None)
     shop_id: int = Field(foreign_key="shop.id")
     shop: Shop = Relationship(back_populates="time_slots")
     reservations: list["Reservation"] = Relationship(back_populates="time_slot")
+    occupancies: list["SlotOccupancy"] = Relationship(
+        back_populates="time_slot", cascade_delete=True
+    )
 
     day: int  # 0=Monday … 6=Sunday
     start_time: datetime.time
@@ -108,9 +154,24 @@ class TimeSlot(SQLModel, table=True):
     valid_until: datetime.date
 
 
+class SlotOccupancy(SQLModel, table=True):
+    """Number of reservations overlapping a time slot on a given date"""
+
+    time_slot_id: int = Field(foreign_key="timeslot.id", primary_key=True)
+    time_slot: TimeSlot = Relationship(back_populates="occupancies")
+    date: datetime.date = Field(primary_key=True)
+    booked: int = 0
+
+
 class Reservation(SQLModel, table=True):
     """Represents a reservation in the database"""
 
+    __table_args__ = (
+        Index("ix_reservation_shop_id_start_time", "shop_id", "start_time"),
+        Index("ix_reservation_user_id_end_time", "user_id", "end_time"),
+        Index("ix_reservation_reminder_sent_start_time", "reminder_sent", "start_time"),
+    )
+
     id: int = Field(primary_key=True, default=None)
     user_id: int = Field(foreign_key="user.id")
     user: User = Relationship(back_populates="reservations")
@@ -122,19 +183,49 @@ class Reservation(SQLModel, table=True):
     end_time: datetime.datetime
     validated: bool = False
     reminder_sent: bool = False
+    # When (ms) it was booked or moved, for the mailers' reminder schedules
+    changed_at: int = Field(default=0, sa_type=BigInteger, index=True)
 
     @staticmethod
-    def find_unsent_reminders(
-        session: "SessionLock", hours_before: int
-    ) -> list["Reservation"]:
-        time_before = datetime.datetime.now() + datetime.timedelta(hours=hours_before)
+    def upcoming_reminders(
+        session: "SessionLock", start: datetime.datetime, end: datetime.datetime
+    ) -> list[tuple[int, datetime.datetime]]:
+        """(id, start time) of the reservations starting in [start, end) not reminded"""
         return session.exec(
-            select(Reservation).where(
+            select(Reservation.id, Reservation.start_time).where(
                 not_(Reservation.reminder_sent),
-                Reservation.start_time < time_before,
+                Reservation.start_time >= start,
+                Reservation.start_time < end,
             )
         ).all()
 
+    @staticmethod
+    def changed_since(
+        session: "SessionLock", since: int
+    ) -> list[tuple[int, datetime.datetime, bool, int]]:
+        """(id, start time, reminder sent, changed at) of the reservations
+        booked or moved since `since` (ms)
+        """
+        return session.exec(
+            select(
+                Reservation.id,
+                Reservation.start_time,
+                Reservation.reminder_sent,
+                Reservation.changed_at,
+            ).where(Reservation.changed_at >= since)
+        ).all()
+
+    @staticmethod
+    def find_unsent_reminders(
+        session: "SessionLock", ids: list[int]
+    ) -> list["Reservation"]:
+        """Reservations among `ids` not reminded yet, with their user and shop"""
+        return session.exec(
+            select(Reservation)
+            .where(Reservation.id.in_(ids), not_(Reservation.reminder_sent))
+            .options(joinedload(Reservation.user), joinedload(Reservation.shop))
+        ).all()
+
     def ics_data(self, cancel: bool = False, update: bool = False) -> dict:
         from shared_planner.db.settings import get
 
@@ -157,7 +248,7 @@ class Token(SQLModel, table=True):
     id: int = Field(primary_key=True, default=None)
     user_id: int = Field(foreign_key="user.id")
     user: User = Relationship(back_populates="tokens")
-    access_token: str
+    access_token: str = Field(index=True, unique=True)
     expires_at: datetime.datetime
     token_type: str = "bearer"
 
@@ -199,8 +290,147 @@ class Setting(SQLModel, table=True):
         return self.value == "True" or self.value == "1"
 
 
+class SchemaVersion(SQLModel, table=True):
+    """Represents a database migration that has been applied"""
+
+    version: int = Field(primary_key=True)
+    applied_at: datetime.datetime
+
+
+class Counter(SQLModel, table=True):
+    """Represents a named counter shared by every worker through the database"""
+
+    key: str = Field(primary_key=True)
+    value: int = Field(default=0, sa_type=BigInteger)  # Some hold ms timestamps
+
+    @staticmethod
+    def read(session: "SessionLock", key: str) -> int:
+        counter = session.exec(select(Counter.value).where(Counter.key == key)).first()
+        return counter or 0
+
+    @staticmethod
+    def bump(session: "SessionLock", key: str, delta: int = 1) -> None:
+        """Increment the counter in the current transaction, creating it if needed"""
+        result = session.exec(
+            update(Counter)
+            .where(Counter.key == key)
+            .values(value=Counter.value + delta)
+        )
+        if result.rowcount == 0:
+            Counter.set(session, key, 0)
+            Counter.bump(session, key, delta)
+
+    @staticmethod
+    def set(session: "SessionLock", key: str, value: int) -> None:
+        """Set the counter in the current transaction, creating it if needed
+
+        Does not flush the session, so it can be used from flush events.
+        """
+        from shared_planner.db.session import insert_ignore  # circular import
+
+        insert_ignore(session, Counter, key=key, value=value)
+        session.exec(update(Counter).where(Counter.key == key).values(value=value))
+
+    @staticmethod
+    def advance(session: "SessionLock", key: str, value: int) -> None:
+        """Raise the counter to `value`, or by one if it already reached it
+
+        Used with timestamps, so two changes in the same millisecond still
+        give two different values. Does not flush the session either.
+        """
+        from shared_planner.db.session import insert_ignore  # circular import
+
+        insert_ignore(session, Counter, key=key, value=value)
+        session.exec(
+            update(Counter)
+            .where(Counter.key == key)
+            .values(
+                value=case((Counter.value >= value, Counter.value + 1), else_=value)
+            )
+        )
+
+
+class Lease(SQLModel, table=True):
+    """Represents an exclusive, expiring role held by one process (e.g. the mailer)"""
+
+    name: str = Field(primary_key=True)
+    holder: str = ""
+    expires_at: datetime.datetime
+
+    @staticmethod
+    def acquire(
+        session: "SessionLock", name: str, holder: str, duration: datetime.timedelta
+    ) -> datetime.datetime | None:
+        """Take or renew the lease, returns its expiry or None if held by another"""
+        from shared_planner.db.session import insert_ignore  # circular import
+
+        now = datetime.datetime.now()
+        insert_ignore(session, Lease, name=name, holder=holder, expires_at=now)
+        result = session.exec(
+            update(Lease)
+            .where(
+                Lease.name == name,
+                or_(Lease.holder == holder, Lease.expires_at < now),
+            )
+            .values(holder=holder, expires_at=now + duration)
+        )
+        session.commit()
+        return now + duration if result.rowcount > 0 else None
+
+    @staticmethod
+    def release(session: "SessionLock", name: str, holder: str) -> None:
+        session.exec(
+            update(Lease)
+            .where(Lease.name == name, Lease.holder == holder)
+            .values(expires_at=datetime.datetime.now())
+        )
+        session.commit()
+
+
+class Event(SQLModel, table=True):
+    """Change pushed to the clients listening on /events (see shared_planner.events)
+
+    Rows are only a short-lived log tailed by every worker, the ids give the
+    delivery order.
+    """
+
+    id: int = Field(primary_key=True, default=None)
+    channel: str  # user:<id>, admins or shop:<id>
+    type: str
+    data: str  # JSON
+    date: datetime.datetime
+
+    @staticmethod
+    def user_channel(user_id: int | None) -> str:
+        """Channel of a user's notifications, None for the admin notifications"""
+        return f"user:{user_id}" if user_id is not None else "admins"
+
+    @staticmethod
+    def publish(session: "SessionLock", channel: str, type: str, data: dict) -> None:
+        """Record an event, delivered once the current transaction is committed
+
+        Does not flush the session, so it can be used from flush events.
+        """
+        session.exec(
+            Event.__table__.insert().values(
+                channel=channel,
+                type=type,
+                data=json.dumps(data),
+                date=datetime.datetime.now(),
+            )
+        )
+
+
 class Notification(SQLModel, table=True):
-    """Represents a notification to a user in the database"""
+    """Represents a notification to a user in the database
+
+    Admin notifications (`user_id=None`) are stored once for every admin, their
+    `read` column is unused: each admin's read state is a NotificationRead row.
+    """
+
+    __table_args__ = (
+        Index("ix_notification_user_id_read_date", "user_id", "read", "date"),
+    )
 
     id: int = Field(primary_key=True, default=None)
     user_id: int | None = Field(foreign_key="user.id", nullable=True)
@@ -212,8 +442,8 @@ class Notification(SQLModel, table=True):
     read: bool = False  # Has the user seen the notification
     route: str | None = None  # Route to send the user to when clicking on the action
 
-    mail: bool = False  # Should the notification be sent by mail
-    mail_sent: bool = False  # Has the mail been sent by the scheduler
+    mail: bool = False  # Should the notification be sent by mail (see MailOutbox)
+    mail_sent: bool = False  # Has the mail been delivered by a mailer
 
     def mark_read(self):
         self.read = True
@@ -243,61 +473,734 @@ class Notification(SQLModel, table=True):
         )
 
     @staticmethod
-    def find_unread(user: User, session: "SessionLock") -> list["Notification"]:
-        return session.exec(
-            select(Notification).where(
+    def unread_key(user_id: int | None) -> str:
+        """Key of the unread counter of a user, None for the admin notifications
+
+        The admin counter holds every admin notification, read or not, an
+        admin's own count is that minus their BROADCAST_READ_KEY_PREFIX counter.
+        """
+        return f"{UNREAD_KEY_PREFIX}{user_id if user_id is not None else 'admins'}"
+
+    @staticmethod
+    def inbox(
+        user: User,
+        session: "SessionLock",
+        unread: bool = False,
+        before_date: datetime.datetime | None = None,
+        before_id: int | None = None,
+        limit: int | None = None,
+    ) -> list["Notification"]:
+        """Notifications of a user (and admin ones for admins), newest first
+
+        The personal and admin notifications are two queries on the
+        (user_id, read, date) index, joined with UNION ALL instead of an OR.
+        The `read` of admin notifications is the user's own read state.
+        Pass the date and id of the last notification of a page as
+        `before_date` and `before_id` to get the next one.
+        """
+        conditions = [Notification.date < datetime.datetime.now()]
+        if before_date is not None and before_id is not None:
+            conditions.append(
                 or_(
-                    Notification.user_id == user.id,
-                    and_(
-                        Notification.user_id == None,  # noqa: E711
-                        true() if user.admin else false(),
-                    ),
-                ),
-                not_(Notification.read),
-                Notification.date < datetime.datetime.now(),
+                    Notification.date < before_date,
+                    and_(Notification.date == before_date, Notification.id < before_id),
+                )
             )
-        ).all()
 
-    @staticmethod
-    def find_unsent(session: "SessionLock"):
-        return session.exec(
-            select(Notification).where(
-                Notification.mail,
-                not_(Notification.mail_sent),
-                Notification.date < datetime.datetime.now(),
+        columns = list(Notification.__table__.columns)
+        branches = [
+            select(*columns).where(
+                Notification.user_id == user.id,
+                *conditions,
+                *([not_(Notification.read)] if unread else []),
             )
-        ).all()
+        ]
+        if user.admin:
+            read = NotificationRead.read_by(user.id)
+            branches.append(
+                select(
+                    *(
+                        read.label("read") if column.name == "read" else column
+                        for column in columns
+                    )
+                ).where(
+                    Notification.user_id == None,  # noqa: E711
+                    *conditions,
+                    *([not_(read)] if unread else []),
+                )
+            )
+        inbox = aliased(Notification, union_all(*branches).subquery())
+        query = select(inbox).order_by(inbox.date.desc(), inbox.id.desc())
+        if limit is not None:
+            query = query.limit(limit)
+        return session.exec(query).all()
+
+    @staticmethod
+    def find_unread(user: User, session: "SessionLock", **page) -> list["Notification"]:
+        return Notification.inbox(user, session, unread=True, **page)
 
     @staticmethod
     def count_unread(user: User, session: "SessionLock") -> int:
+        """Read from the counters maintained on every flush, see _track_unread"""
+        keys = [Notification.unread_key(user.id)]
+        read_key = NotificationRead.read_key(user.id)
+        if user.admin:
+            keys += [Notification.unread_key(None), read_key]
         return session.exec(
-            select(func.count(Notification.id)).where(
-                or_(
-                    Notification.user_id == user.id,
-                    and_(
-                        Notification.user_id == None,  # noqa: E711
-                        true() if user.admin else false(),
+            select(
+                func.coalesce(
+                    func.sum(
+                        case(
+                            (Counter.key == read_key, -Counter.value),
+                            else_=Counter.value,
+                        )
                     ),
-                ),
-                not_(Notification.read),
-                Notification.date < datetime.datetime.now(),
+                    0,
+                )
+            ).where(Counter.key.in_(keys))
+        ).one()
+
+    @staticmethod
+    def unread_changed(session: "SessionLock", user_id: int | None, delta: int) -> None:
+        """Update the unread counter of a recipient and notify its clients"""
+        Counter.bump(session, Notification.unread_key(user_id), delta)
+        Event.publish(session, Event.user_channel(user_id), "unread", {"delta": delta})
+
+    @staticmethod
+    def set_read_many(
+        session: "SessionLock", user: User, read: bool, ids: list[int] | None = None
+    ) -> int:
+        """Mark the notifications of a user's inbox (all or `ids`) read or unread
+
+        Runs one UPDATE per recipient, returns the number of changed notifications.
+        """
+        query = update(Notification).where(
+            Notification.user_id == user.id, Notification.read == (not read)
+        )
+        if ids is not None:
+            query = query.where(Notification.id.in_(ids))
+        count = session.exec(query.values(read=read)).rowcount
+        if count:
+            Notification.unread_changed(session, user.id, -count if read else count)
+        if user.admin:
+            if read:
+                count += NotificationRead.mark(session, user.id, ids)
+            else:
+                count += NotificationRead.unmark(session, user.id, ids)
+        return count
+
+    @staticmethod
+    def delete_many(
+        session: "SessionLock", user: User, ids: list[int] | None = None
+    ) -> int:
+        """Delete notifications of a user's inbox, returns how many were deleted
+
+        Without `ids` only the personal notifications are deleted, the admin
+        ones are shared and deleted for every admin. Unread and read
+        notifications are deleted separately to know by how much the unread
+        counter goes down.
+        """
+        total = 0
+        for read in (False, True):
+            query = delete(Notification).where(
+                Notification.user_id == user.id, Notification.read == read
             )
-        ).first()
+            if ids is not None:
+                query = query.where(Notification.id.in_(ids))
+            count = session.exec(query).rowcount
+            if count and not read:
+                Notification.unread_changed(session, user.id, -count)
+            total += count
+
+        if ids is not None and user.admin:
+            broadcasts = session.exec(
+                select(Notification.id).where(
+                    Notification.user_id == None,  # noqa: E711
+                    Notification.id.in_(ids),
+                )
+            ).all()
+            if broadcasts:
+                NotificationRead.forget(session, broadcasts)
+                count = session.exec(
+                    delete(Notification).where(Notification.id.in_(broadcasts))
+                ).rowcount
+                Notification.unread_changed(session, None, -count)
+                total += count
+        return total
 
     @staticmethod
-    def list_notifications(user: User, session: "SessionLock") -> list["Notification"]:
-        return session.exec(
-            select(Notification).where(
+    def delete_where(session: "SessionLock", *conditions) -> int:
+        """Bulk delete the notifications matching `conditions`, returns how many
+
+        The unread counters are not updated, call recount_unread afterwards.
+        """
+        NotificationRead.forget(
+            session,
+            select(Notification.id).where(
+                Notification.user_id == None,  # noqa: E711
+                *conditions,
+            ),
+        )
+        return session.exec(delete(Notification).where(*conditions)).rowcount
+
+    @staticmethod
+    def recount_unread(session: "SessionLock") -> None:
+        """Rebuild the unread counters, needed after bulk deletes or updates"""
+        prefixes = or_(
+            Counter.key.startswith(UNREAD_KEY_PREFIX),
+            Counter.key.startswith(BROADCAST_READ_KEY_PREFIX),
+        )
+        previous = dict(
+            session.exec(select(Counter.key, Counter.value).where(prefixes)).all()
+        )
+        # Read states of deleted notifications or users
+        session.exec(
+            delete(NotificationRead).where(
                 or_(
-                    Notification.user_id == user.id,
-                    and_(
+                    NotificationRead.notification_id.not_in(select(Notification.id)),
+                    NotificationRead.user_id.not_in(select(User.id)),
+                )
+            )
+        )
+        counts = {
+            Notification.unread_key(user_id): count
+            for user_id, count in session.exec(
+                select(Notification.user_id, func.count(Notification.id))
+                .where(
+                    or_(
                         Notification.user_id == None,  # noqa: E711
-                        true() if user.admin else false(),
-                    ),
-                ),
-                Notification.date < datetime.datetime.now(),
+                        not_(Notification.read),
+                    )
+                )
+                .group_by(Notification.user_id)
+            ).all()
+        }
+        counts.update(
+            (NotificationRead.read_key(user_id), count)
+            for user_id, count in session.exec(
+                select(NotificationRead.user_id, func.count()).group_by(
+                    NotificationRead.user_id
+                )
+            ).all()
+        )
+        session.exec(update(Counter).where(prefixes).values(value=0))
+        for key, count in counts.items():
+            Counter.set(session, key, count)
+
+        for key in previous.keys() | counts.keys():
+            delta = counts.get(key, 0) - previous.get(key, 0)
+            if delta == 0:
+                continue
+            if key.startswith(BROADCAST_READ_KEY_PREFIX):
+                user_id = int(key.removeprefix(BROADCAST_READ_KEY_PREFIX))
+                delta = -delta
+            else:
+                suffix = key.removeprefix(UNREAD_KEY_PREFIX)
+                user_id = None if suffix == "admins" else int(suffix)
+            Event.publish(
+                session, Event.user_channel(user_id), "unread", {"delta": delta}
+            )
+
+    @staticmethod
+    def list_notifications(
+        user: User, session: "SessionLock", **page
+    ) -> list["Notification"]:
+        return Notification.inbox(user, session, **page)
+
+
+class NotificationRead(SQLModel, table=True):
+    """Represents an admin notification read by one admin
+
+    The primary key answers "has admin X read it" for the unread queries, the
+    notification_id index finds the rows to drop with a notification.
+    """
+
+    user_id: int = Field(foreign_key="user.id", primary_key=True)
+    notification_id: int = Field(
+        foreign_key="notification.id", primary_key=True, index=True
+    )
+
+    @staticmethod
+    def read_key(user_id: int) -> str:
+        return f"{BROADCAST_READ_KEY_PREFIX}{user_id}"
+
+    @staticmethod
+    def read_by(user_id: int):
+        """Condition true for the admin notifications read by a user"""
+        return exists().where(
+            NotificationRead.user_id == user_id,
+            NotificationRead.notification_id == Notification.id,
+        )
+
+    @staticmethod
+    def _changed(session: "SessionLock", user_id: int, count: int) -> None:
+        """Count `count` more read admin notifications for a user"""
+        Counter.bump(session, NotificationRead.read_key(user_id), count)
+        Event.publish(session, Event.user_channel(user_id), "unread", {"delta": -count})
+
+    @staticmethod
+    def mark(session: "SessionLock", user_id: int, ids: list[int] | None = None) -> int:
+        """Mark admin notifications (all or `ids`) read for a user, in one INSERT"""
+        query = select(Notification.id, user_id).where(
+            Notification.user_id == None,  # noqa: E711
+            not_(NotificationRead.read_by(user_id)),
+        )
+        if ids is not None:
+            query = query.where(Notification.id.in_(ids))
+        count = session.exec(
+            insert(NotificationRead)
+            .from_select(["notification_id", "user_id"], query)
+            # SQLAlchemy only keeps the rowcount of an INSERT on request
+            .execution_options(preserve_rowcount=True)
+        ).rowcount
+        if count:
+            NotificationRead._changed(session, user_id, count)
+        return count
+
+    @staticmethod
+    def unmark(
+        session: "SessionLock", user_id: int, ids: list[int] | None = None
+    ) -> int:
+        """Mark admin notifications (all or `ids`) unread for a user"""
+        query = delete(NotificationRead).where(NotificationRead.user_id == user_id)
+        if ids is not None:
+            query = query.where(NotificationRead.notification_id.in_(ids))
+        count = session.exec(query).rowcount
+        if count:
+            NotificationRead._changed(session, user_id, -count)
+        return count
+
+    @staticmethod
+    def forget(session: "SessionLock", ids: list[int] | Select) -> None:
+        """Drop the read states of admin notifications about to be deleted
+
+        `ids` is a list or a query of notification ids. Must run before the
+        notifications are deleted, their foreign key is enforced on PostgreSQL.
+        Does not flush the session, so it can be used from flush events.
+        """
+        readers = session.exec(
+            select(NotificationRead.user_id, func.count())
+            .where(NotificationRead.notification_id.in_(ids))
+            .group_by(NotificationRead.user_id)
+        ).all()
+        session.exec(
+            delete(NotificationRead).where(NotificationRead.notification_id.in_(ids))
+        )
+        for user_id, count in readers:
+            NotificationRead._changed(session, user_id, -count)
+
+
+def _stored_read(notification: Notification) -> bool:
+    """Value of `read` in the database, before the changes being flushed"""
+    history = inspect(notification).attrs.read.history
+    return history.deleted[0] if history.deleted else notification.read
+
+
+@event.listens_for(Session, "before_flush")
+def _forget_deleted_broadcasts(session: Session, flush_context, instances) -> None:
+    """Drop the read states of the admin notifications deleted by this flush"""
+    broadcasts = [
+        notification.id
+        for notification in session.deleted
+        if isinstance(notification, Notification) and notification.user_id is None
+    ]
+    if broadcasts:
+        NotificationRead.forget(session, broadcasts)
+
+
+@event.listens_for(Session, "after_flush")
+def _track_unread(session: Session, flush_context) -> None:
+    """Keep the unread counters in sync with the notifications being flushed"""
+    deltas: dict[int | None, int] = defaultdict(int)
+    for notification in session.new:
+        if isinstance(notification, Notification):
+            if notification.user_id is None or not notification.read:
+                deltas[notification.user_id] += 1
+    for notification in session.dirty:
+        if isinstance(notification, Notification) and notification.user_id is not None:
+            stored = _stored_read(notification)
+            if stored != notification.read:
+                deltas[notification.user_id] += 1 if stored else -1
+    for notification in session.deleted:
+        if isinstance(notification, Notification):
+            if notification.user_id is None:
+                deltas[None] -= 1
+            elif not _stored_read(notification):
+                deltas[notification.user_id] -= 1
+
+    for user_id, delta in deltas.items():
+        if delta != 0:
+            Notification.unread_changed(session, user_id, delta)
+
+
+@event.listens_for(Session, "after_flush")
+def _track_admins(session: Session, flush_context) -> None:
+    """Tell the mailers to reload their admin recipients when admins change"""
+    changed = any(
+        isinstance(user, User) and user.admin
+        for user in (*session.new, *session.deleted)
+    ) or any(
+        isinstance(user, User)
+        and (
+            inspect(user).attrs.admin.history.has_changes()
+            or user.admin
+            and (
+                inspect(user).attrs.email.history.has_changes()
+                or inspect(user).attrs.full_name.history.has_changes()
+            )
+        )
+        for user in session.dirty
+    )
+    if changed:
+        Counter.bump(session, ADMINS_VERSION_KEY)
+
+
+@event.listens_for(Session, "after_flush")
+def _track_principals(session: Session, flush_context) -> None:
+    """Tell every worker to drop its cached tokens when users or tokens change"""
+    changed = any(isinstance(obj, (User, Token)) for obj in session.deleted) or any(
+        isinstance(user, User) and session.is_modified(user) for user in session.dirty
+    )
+    if changed:
+        Counter.bump(session, PRINCIPALS_VERSION_KEY)
+
+
+def _changed(obj, *names: str) -> bool:
+    """Whether any of these attributes is modified in the flush"""
+    state = inspect(obj)
+    return any(state.attrs[name].history.has_changes() for name in names)
+
+
+@event.listens_for(Session, "after_flush")
+def _track_calendars(session: Session, flush_context) -> None:
+    """Date the changes of the reservations shown in each calendar feed"""
+    keys = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Reservation):
+            if obj in session.dirty and not _changed(
+                obj, "user_id", "shop_id", "start_time", "end_time"
+            ):
+                continue
+            keys.add(f"{CALENDAR_KEY_PREFIX}user:{obj.user_id}")
+            keys.add(f"{CALENDAR_KEY_PREFIX}shop:{obj.shop_id}")
+            # Reassigned reservations leave the calendar of their former user
+            for user_id in inspect(obj).attrs.user_id.history.deleted:
+                keys.add(f"{CALENDAR_KEY_PREFIX}user:{user_id}")
+        elif isinstance(obj, Shop):
+            if obj in session.dirty and not _changed(obj, "name", "maps_link"):
+                continue
+            keys.add(f"{CALENDAR_KEY_PREFIX}shops")
+        elif isinstance(obj, User):
+            # Shop feeds show the name of who booked
+            if obj not in session.dirty or not _changed(obj, "full_name"):
+                continue
+            shop_ids = session.exec(
+                select(Reservation.shop_id)
+                .where(Reservation.user_id == obj.id)
+                .distinct()
+            ).all()
+            for shop_id in shop_ids:
+                keys.add(f"{CALENDAR_KEY_PREFIX}shop:{shop_id}")
+    changed_at = int(time.time() * 1000)
+    for key in keys:
+        Counter.advance(session, key, changed_at)
+
+
+def _week_key(shop_id: int, start_time: datetime.datetime) -> str:
+    monday = start_time.date() - datetime.timedelta(days=start_time.weekday())
+    return f"{VERSION_KEY_PREFIX}week:{shop_id}:{monday.isoformat()}"
+
+
+@event.listens_for(Session, "after_flush")
+def _track_versions(session: Session, flush_context) -> None:
+    """Date the changes of the data behind the cached API responses"""
+    keys = set()
+    for obj in (*session.new, *session.dirty, *session.deleted):
+        if isinstance(obj, Reservation):
+            if obj in session.dirty and not _changed(
+                obj, "user_id", "shop_id", "start_time", "end_time", "validated"
+            ):
+                continue
+            keys.add(_week_key(obj.shop_id, obj.start_time))
+            # Moved reservations also leave their former week
+            attrs = inspect(obj).attrs
+            for shop_id in attrs.shop_id.history.deleted or [obj.shop_id]:
+                for start_time in attrs.start_time.history.deleted or [obj.start_time]:
+                    keys.add(_week_key(shop_id, start_time))
+        elif isinstance(obj, (Shop, OpeningTime, TimeSlot)):
+            # Relationship changes (e.g. a new reservation) leave the columns as is
+            if obj in session.dirty and not _changed(
+                obj, *(column.key for column in inspect(obj).mapper.column_attrs)
+            ):
+                continue
+            if isinstance(obj, Shop):
+                keys.add(f"{VERSION_KEY_PREFIX}shops")
+                keys.add(f"{VERSION_KEY_PREFIX}shop:{obj.id}")
+            elif isinstance(obj, OpeningTime):
+                keys.add(f"{VERSION_KEY_PREFIX}shop:{obj.shop_id}")
+            else:
+                keys.add(f"{VERSION_KEY_PREFIX}slots:{obj.shop_id}")
+    if keys:
+        session.info["versions_changed"] = True
+    changed_at = int(time.time() * 1000)
+    for key in keys:
+        Counter.advance(session, key, changed_at)
+
+
+@event.listens_for(Session, "before_flush")
+def _stamp_reservations(session: Session, flush_context, instances) -> None:
+    """Date the reservations booked or moved, see Reservation.changed_since"""
+    changed_at = int(time.time() * 1000)
+    for reservation in session.new:
+        if isinstance(reservation, Reservation):
+            reservation.changed_at = changed_at
+    for reservation in session.dirty:
+        if (
+            isinstance(reservation, Reservation)
+            and inspect(reservation).attrs.start_time.history.has_changes()
+        ):
+            reservation.changed_at = changed_at
+
+
+@event.listens_for(Session, "after_flush")
+def _track_reminders(session: Session, flush_context) -> None:
+    """Tell the mailer to reload its reminder schedule when reservations change"""
+    changed = any(
+        isinstance(reservation, Reservation)
+        for reservation in (*session.new, *session.deleted)
+    ) or any(
+        isinstance(reservation, Reservation)
+        and inspect(reservation).attrs.start_time.history.has_changes()
+        for reservation in session.dirty
+    )
+    if changed:
+        Counter.bump(session, REMINDERS_VERSION_KEY)
+
+
+class MailOutbox(SQLModel, table=True):
+    """Represents a mail waiting to be delivered by a mailer
+
+    Rows are written in the transaction creating what they are about, so no
+    mail is lost if a mailer stops. A mailer claims pending rows by batches,
+    the claim holds them until `available_at`: a crashed mailer's rows are
+    taken back by another one once it has expired.
+    """
+
+    __table_args__ = (
+        Index("ix_mailoutbox_status_available_at", "status", "available_at"),
+    )
+
+    id: int = Field(primary_key=True, default=None)
+    notification_id: int | None = None  # Its mail_sent is set once delivered
+    name: str
+    email: str
+    template: str
+    data: str  # JSON
+    status: str = "pending"  # pending, sent or dead (too many failed attempts)
+    digest: bool = False  # Can be grouped with the other digest mails of the recipient
+    # Sent once to every admin, the name and email are empty
+    admins: bool = False
+    attempts: int = 0
+    available_at: datetime.datetime  # When it can be claimed (again)
+    claim: str | None = None  # Token of the batch holding it
+    last_error: str | None = None
+    created_at: datetime.datetime
+    sent_at: datetime.datetime | None = None
+
+    @staticmethod
+    def enqueue(
+        session: "SessionLock",
+        name: str,
+        email: str,
+        template: str,
+        data: dict,
+        notification_id: int | None = None,
+        digest_at: datetime.datetime | None = None,
+        admins: bool = False,
+    ) -> None:
+        """Add a mail to the outbox in the current transaction
+
+        Digest mails wait for `digest_at`, see `digest_windows`. Does not flush
+        the session, so it can be used from flush events.
+        """
+        now = datetime.datetime.now()
+        session.exec(
+            MailOutbox.__table__.insert().values(
+                notification_id=notification_id,
+                name=name,
+                email=email,
+                template=template,
+                data=json.dumps(data),
+                digest=digest_at is not None,
+                admins=admins,
+                available_at=digest_at or now,
+                created_at=now,
             )
+        )
+
+    @staticmethod
+    def digest_windows(
+        session: "SessionLock", emails: list[str]
+    ) -> dict[str, datetime.datetime]:
+        """When the digest mails waiting for each recipient will be sent"""
+        if not emails:
+            return {}
+        return dict(
+            session.exec(
+                select(MailOutbox.email, func.min(MailOutbox.available_at))
+                .where(
+                    MailOutbox.email.in_(emails),
+                    MailOutbox.digest,
+                    MailOutbox.status == "pending",
+                    MailOutbox.claim == None,  # noqa: E711
+                    MailOutbox.attempts == 0,
+                )
+                .group_by(MailOutbox.email)
+            ).all()
+        )
+
+    @staticmethod
+    def claim_batch(
+        session: "SessionLock", limit: int, lease: datetime.timedelta
+    ) -> list["MailOutbox"]:
+        """Claim up to `limit` pending mails for `lease`, commits the claim
+
+        The UPDATE checks again that the rows are available, so concurrent
+        mailers never claim the same row.
+        """
+        now = datetime.datetime.now()
+        ids = session.exec(
+            select(MailOutbox.id)
+            .where(MailOutbox.status == "pending", MailOutbox.available_at <= now)
+            .order_by(MailOutbox.available_at)
+            .limit(limit)
         ).all()
+        if not ids:
+            return []
+        token = secrets.token_hex(16)
+        session.exec(
+            update(MailOutbox)
+            .where(
+                MailOutbox.id.in_(ids),
+                MailOutbox.status == "pending",
+                MailOutbox.available_at <= now,
+            )
+            .values(claim=token, available_at=now + lease)
+        )
+        session.commit()
+        return session.exec(select(MailOutbox).where(MailOutbox.claim == token)).all()
+
+    @staticmethod
+    def mark_sent(session: "SessionLock", mails: list["MailOutbox"]) -> None:
+        now = datetime.datetime.now()
+        for mail in mails:
+            session.exec(
+                update(MailOutbox)
+                .where(MailOutbox.id == mail.id, MailOutbox.claim == mail.claim)
+                .values(status="sent", sent_at=now, attempts=MailOutbox.attempts + 1)
+            )
+        notification_ids = [
+            mail.notification_id for mail in mails if mail.notification_id is not None
+        ]
+        if notification_ids:
+            session.exec(
+                update(Notification)
+                .where(Notification.id.in_(notification_ids))
+                .values(mail_sent=True)
+            )
+        session.commit()
+
+    @staticmethod
+    def mark_failed(
+        session: "SessionLock",
+        mails: list["MailOutbox"],
+        error: str,
+        max_attempts: int,
+        retry_delay: float,
+    ) -> bool:
+        """Record a failed attempt, returns False once the mails are dead-lettered
+
+        The next attempt waits `retry_delay` seconds, doubled at each failure.
+        """
+        now = datetime.datetime.now()
+        alive = False
+        for mail in mails:
+            attempts = mail.attempts + 1
+            dead = attempts >= max_attempts
+            alive = alive or not dead
+            session.exec(
+                update(MailOutbox)
+                .where(MailOutbox.id == mail.id, MailOutbox.claim == mail.claim)
+                .values(
+                    status="dead" if dead else "pending",
+                    attempts=attempts,
+                    last_error=error[:1000],
+                    claim=None,
+                    available_at=now
+                    + datetime.timedelta(seconds=retry_delay * 2 ** (attempts - 1)),
+                )
+            )
+        session.commit()
+        return alive
+
+
+@event.listens_for(Session, "after_flush")
+def _queue_mails(session: Session, flush_context) -> None:
+    """Put the mails of the notifications being created in the outbox"""
+    notifications = [
+        notification
+        for notification in session.new
+        if isinstance(notification, Notification)
+        and notification.mail
+        and not notification.mail_sent
+    ]
+    if not notifications:
+        return
+
+    recipients = []
+    for notification in notifications:
+        if notification.user_id is None:
+            users = [("", "")]  # Resolved to every admin by the mailer
+        else:
+            users = session.exec(
+                select(User.full_name, User.email).where(
+                    User.id == notification.user_id
+                )
+            ).all()
+        recipients.append((notification, users))
+
+    # Reminders and admin notifications join the pending digest of the recipient
+    windows = MailOutbox.digest_windows(
+        session,
+        list(
+            {
+                email
+                for notification, users in recipients
+                if notification.is_reminder or notification.user_id is None
+                for _, email in users
+            }
+        ),
+    )
+    window_end = datetime.datetime.now() + MAIL_DIGEST_WINDOW
+    for notification, users in recipients:
+        digest = notification.is_reminder or notification.user_id is None
+        data = json.loads(notification.data) if notification.data else {}
+        if notification.route:
+            data["route"] = notification.route
+        for name, email in users:
+            digest_at = None
+            if digest:
+                digest_at = windows.setdefault(email, window_end)
+            MailOutbox.enqueue(
+                session,
+                name,
+                email,
+                notification.message,
+                data,
+                notification.id,
+                digest_at,
+                admins=notification.user_id is None,
+            )
 
 
 class PasswordReset(SQLModel, table=True):
@@ -1,7 +1,9 @@
 import datetime
 import json
+import os
+from dotenv import load_dotenv
 from sqlmodel import SQLModel, create_engine, Session as _Session
-from sqlalchemy import Engine
+from sqlalchemy import Engine, event, make_url
 from shared_planner.db.models import (
     User,
     Shop,
@@ -13,8 +15,44 @@ from shared_planner.db.models import (
 )
 
 
+from shared_planner.db.migrations import run_migrations
 from contextlib import contextmanager
 
+load_dotenv()
+
+DATABASE_URL = os.getenv("DATABASE_URL", "sqlite:///database.db")
+
+# Applied to every new SQLite connection. WAL lets readers run while a booking
+# writes, and NORMAL is durable in WAL mode except on power loss.
+SQLITE_PRAGMAS = {
+    "journal_mode": os.getenv("SQLITE_JOURNAL_MODE", "WAL"),
+    "synchronous": os.getenv("SQLITE_SYNCHRONOUS", "NORMAL"),
+    "busy_timeout": int(os.getenv("SQLITE_BUSY_TIMEOUT_MS", 15000)),
+    "mmap_size": int(os.getenv("SQLITE_MMAP_SIZE", 256 * 1024 * 1024)),
+    "cache_size": int(os.getenv("SQLITE_CACHE_SIZE", -64 * 1024)),  # In KiB if < 0
+    "temp_store": "MEMORY",
+}
+
+# Default pool of each worker, per backend. SQLite only has one writer at a
+# time: a few connections are enough to keep the readers busy, more only queue
+# on the write lock. Server databases are shared by every worker of every node.
+POOL_DEFAULTS = {
+    "sqlite": {"pool_size": 4, "max_overflow": 8, "pool_timeout": 30},
+    "postgresql": {
+        "pool_size": 10,
+        "max_overflow": 10,
+        "pool_timeout": 30,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+    },
+}
+POOL_ENV = {
+    "pool_size": "DB_POOL_SIZE",
+    "max_overflow": "DB_MAX_OVERFLOW",
+    "pool_timeout": "DB_POOL_TIMEOUT",
+    "pool_recycle": "DB_POOL_RECYCLE",
+}
+
 
 class Singleton(type):
     _instances = {}
@@ -26,27 +64,43 @@ class Singleton(type):
         return cls._instances[cls]
 
 
-def _run_migrations(engine: Engine) -> None:
-    from sqlalchemy import inspect, text
-    inspector = inspect(engine)
-    tables = inspector.get_table_names()
-    if "reservation" in tables:
-        cols = [c["name"] for c in inspector.get_columns("reservation")]
-        if "time_slot_id" not in cols:
-            with engine.connect() as conn:
-                conn.execute(text("ALTER TABLE reservation ADD COLUMN time_slot_id INTEGER REFERENCES timeslot(id)"))
-                conn.commit()
+def _pool_options(url: str) -> dict:
+    url = make_url(url)
+    if url.get_backend_name() == "sqlite" and url.database in (None, "", ":memory:"):
+        return {}  # In-memory databases use a single shared connection
+
+    options = dict(POOL_DEFAULTS.get(url.get_backend_name(), {}))
+    for option, variable in POOL_ENV.items():
+        if os.getenv(variable) is not None:
+            options[option] = int(os.getenv(variable))
+    return options
+
+
+def _apply_sqlite_pragmas(dbapi_connection, connection_record) -> None:
+    cursor = dbapi_connection.cursor()
+    for name, value in SQLITE_PRAGMAS.items():
+        cursor.execute(f"PRAGMA {name}={value}")
+    cursor.close()
 
 
 class EngineContainer(metaclass=Singleton):
     engine: Engine
 
     def __init__(self):
-        self.engine = create_engine(
-            "sqlite:///database.db", pool_timeout=10, max_overflow=50, pool_size=5
-        )
-        SQLModel.metadata.create_all(self.engine)
-        _run_migrations(self.engine)
+        self.engine = create_engine(DATABASE_URL, **_pool_options(DATABASE_URL))
+        if self.engine.dialect.name == "sqlite":
+            event.listen(self.engine, "connect", _apply_sqlite_pragmas)
+        run_migrations(self.engine)
+
+
+def insert_ignore(session: _Session, model: type[SQLModel], **values) -> None:
+    """Insert a row unless one with the same key already exists"""
+    if session.get_bind().dialect.name == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert
+
+    session.exec(insert(model).values(**values).on_conflict_do_nothing())
 
 
 @contextmanager
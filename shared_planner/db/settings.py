@@ -1,8 +1,17 @@
+import os
+import threading
+import time
+
 from sqlalchemy import delete
 from sqlmodel import select
-from shared_planner.db.models import Setting
+from shared_planner.db.models import Counter, Setting
 from shared_planner.db.session import SessionLock
 
+# Maximum time (in seconds) before a worker notices a setting changed by another worker
+SETTINGS_CHECK_INTERVAL = float(os.getenv("SETTINGS_CHECK_INTERVAL", 5))
+# Key of the counter bumped every time the settings change
+SETTINGS_VERSION_KEY = "settings"
+
 
 # key: (value, private?)
 DEFAULTS = {
@@ -121,14 +130,76 @@ def init_settings():
                 )
 
         session.add_all(settings)
+        notify_changed(session)
         session.commit()
 
+    cache.invalidate()
     return
 
 
-def get(name: str) -> Setting:
-    with SessionLock() as session:
-        setting = session.get(Setting, name)
+class SettingsCache:
+    """In-process copy of the settings table
+
+    Every row is loaded at once and served from memory. The settings version
+    counter is checked at most every SETTINGS_CHECK_INTERVAL seconds so that
+    changes made by other workers are picked up within a bounded time.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._settings: dict[str, Setting] = {}
+        self._version: int | None = None
+        self._checked_at = 0.0
+
+    def invalidate(self) -> None:
+        """Force a reload on the next access"""
+        self._version = None
+
+    def _is_fresh(self, now: float) -> bool:
+        return (
+            self._version is not None
+            and now - self._checked_at < SETTINGS_CHECK_INTERVAL
+        )
+
+    def _refresh(self) -> None:
+        now = time.monotonic()
+        if self._is_fresh(now):
+            return
+
+        with self._lock:
+            if self._is_fresh(now):
+                return  # Another thread refreshed the cache in the meantime
+
+            with SessionLock() as session:
+                version = Counter.read(session, SETTINGS_VERSION_KEY)
+                if version != self._version:
+                    settings = session.exec(select(Setting)).all()
+                    self._settings = {setting.key: setting for setting in settings}
+                    self._version = version
+            self._checked_at = now
+
+    def get(self, name: str) -> Setting:
+        self._refresh()
+        setting = self._settings.get(name)
         if setting is None:
             raise ValueError(f"Setting '{name}' not found")
-    return setting
+        return setting
+
+    def all(self) -> list[Setting]:
+        self._refresh()
+        return list(self._settings.values())
+
+
+cache = SettingsCache()
+
+
+def notify_changed(session: SessionLock) -> None:
+    """Tell every worker that the settings changed, in the current transaction
+
+    The local cache must still be invalidated once the transaction is committed.
+    """
+    Counter.bump(session, SETTINGS_VERSION_KEY)
+
+
+def get(name: str) -> Setting:
+    return cache.get(name)
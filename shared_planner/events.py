@@ -0,0 +1,186 @@
+import asyncio
+import datetime
+import os
+import time
+from collections import defaultdict
+from collections.abc import Iterable
+
+from sqlmodel import delete, func, or_, select
+from starlette.concurrency import run_in_threadpool
+
+from shared_planner.db.models import Event
+from shared_planner.db.session import SessionLock
+
+EVENT_POLL_INTERVAL = float(os.getenv("EVENT_POLL_INTERVAL", 0.5))  # Seconds
+EVENT_RETENTION = datetime.timedelta(
+    seconds=int(os.getenv("EVENT_RETENTION_SECONDS", 300))
+)
+EVENT_CLEANUP_INTERVAL = 60  # Seconds
+EVENT_BATCH_SIZE = 500
+# Ids are given before commit, so on PostgreSQL an event may appear after
+# greater ids: ids skipped by the log are read again for this long
+EVENT_GAP_TIMEOUT = 60  # Seconds
+# Ids checked for such gaps before the position of the first client
+EVENT_GAP_LOOKBACK = 100
+SUBSCRIBER_QUEUE_SIZE = 256
+
+
+def last_event_id(session: SessionLock) -> int:
+    """High-water mark of the event log, to subscribe from"""
+    return session.exec(select(func.max(Event.id))).one() or 0
+
+
+def purge_events(session: SessionLock) -> int:
+    """Delete the events older than EVENT_RETENTION, returns their number"""
+    result = session.exec(
+        delete(Event).where(Event.date < datetime.datetime.now() - EVENT_RETENTION)
+    )
+    return result.rowcount
+
+
+class Subscription:
+    """Events of some channels waiting to be sent to one client"""
+
+    def __init__(self, channels: Iterable[str], since: int):
+        self.channels = set(channels)
+        self.since = since  # Id of the last event handled for this client
+        self.queue: asyncio.Queue[tuple[str, str]] = asyncio.Queue(
+            SUBSCRIBER_QUEUE_SIZE
+        )
+        # Set when the client is too slow, it must reconnect and reload its state
+        self.lagging = False
+
+
+class EventBroker:
+    """Tails the event table and fans the new events out to this worker's clients
+
+    Each worker runs one poll loop whatever its number of clients, and only
+    reads the log while at least one client is connected, from the oldest
+    position of its subscriptions. Ids skipped by the log are remembered and
+    their events delivered late if they appear within EVENT_GAP_TIMEOUT, so
+    events must carry absolute values. Old events are deleted every
+    EVENT_CLEANUP_INTERVAL, with or without clients.
+    """
+
+    def __init__(self):
+        self._subscriptions: dict[str, set[Subscription]] = defaultdict(set)
+        self._all: set[Subscription] = set()
+        self._last_id: int | None = None  # Greatest id read, None while idle
+        self._gaps: dict[int, float] = {}  # Ids skipped -> when (monotonic)
+        self._last_cleanup = 0.0
+        self._task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def subscribe(self, channels: Iterable[str], since: int) -> Subscription:
+        """Deliver the events of `channels` with an id above `since`"""
+        subscription = Subscription(channels, since)
+        for channel in subscription.channels:
+            self._subscriptions[channel].add(subscription)
+        self._all.add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription) -> None:
+        self._all.discard(subscription)
+        for channel in subscription.channels:
+            self._subscriptions[channel].discard(subscription)
+            if not self._subscriptions[channel]:
+                del self._subscriptions[channel]
+
+    def _cleanup(self) -> None:
+        with SessionLock() as session:
+            purge_events(session)
+            session.commit()
+
+    def _fetch(self, after: int, gaps: list[int]) -> list[tuple[int, str, str, str]]:
+        with SessionLock() as session:
+            return session.exec(
+                select(Event.id, Event.channel, Event.type, Event.data)
+                .where(or_(Event.id > after, Event.id.in_(gaps)))
+                .order_by(Event.id)
+                .limit(EVENT_BATCH_SIZE)
+            ).all()
+
+    def _dispatch(
+        self,
+        polled: set[Subscription],
+        id: int,
+        channel: str,
+        type: str,
+        data: str,
+        late: bool,
+    ) -> None:
+        for subscription in self._subscriptions.get(channel, ()):
+            # Subscriptions made during the poll may start before it, the
+            # next poll delivers their events
+            if subscription not in polled:
+                continue
+            if id <= subscription.since and not late:
+                continue
+            try:
+                subscription.queue.put_nowait((type, data))
+            except asyncio.QueueFull:
+                subscription.lagging = True
+
+    async def _poll(self) -> int:
+        """Read the log once and dispatch its new events, returns their number"""
+        if not self._all:
+            self._last_id = None
+            self._gaps.clear()
+            return 0
+
+        polled = set(self._all)
+        after = min(subscription.since for subscription in polled)
+        if self._last_id is None:
+            after = max(after - EVENT_GAP_LOOKBACK, 0)
+            self._last_id = after
+        now = time.monotonic()
+        self._gaps = {
+            id: noticed
+            for id, noticed in self._gaps.items()
+            if now - noticed < EVENT_GAP_TIMEOUT
+        }
+        try:
+            events = await run_in_threadpool(self._fetch, after, list(self._gaps))
+        except Exception as e:
+            print(f"Failed to read events: {e}")
+            return 0
+
+        for id, channel, type, data in events:
+            late = self._gaps.pop(id, None) is not None
+            if id > self._last_id:
+                start = max(self._last_id + 1, id - EVENT_BATCH_SIZE)
+                self._gaps.update(dict.fromkeys(range(start, id), now))
+                self._last_id = id
+            self._dispatch(polled, id, channel, type, data, late)
+        if events:
+            # Every polled subscription has now handled the events up to there
+            for subscription in polled:
+                subscription.since = max(subscription.since, events[-1][0])
+        return len(events)
+
+    async def _run(self) -> None:
+        while True:
+            if time.monotonic() - self._last_cleanup > EVENT_CLEANUP_INTERVAL:
+                self._last_cleanup = time.monotonic()
+                try:
+                    await run_in_threadpool(self._cleanup)
+                except Exception as e:
+                    print(f"Failed to delete old events: {e}")
+
+            if await self._poll() == EVENT_BATCH_SIZE:
+                continue  # More are waiting
+            await asyncio.sleep(EVENT_POLL_INTERVAL)
+
+
+broker = EventBroker()
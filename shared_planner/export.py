@@ -0,0 +1,235 @@
+import csv
+import datetime
+import os
+from collections.abc import Iterator
+
+from fastapi import HTTPException
+from sqlmodel import select
+
+from shared_planner.db.models import Reservation, Shop, TimeSlot, User
+from shared_planner.db.session import SessionLock
+
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 1000))
+
+CSV_COLUMNS = [
+    "shop_name",
+    "user_name",
+    "user_email",
+    "user_group",
+    "user_admin",
+    "start_time",
+    "duration",
+]
+
+
+class _Line:
+    """File-like object handing back what the csv writer writes"""
+
+    def write(self, value: str) -> str:
+        return value
+
+
+def _filtered(
+    query,
+    start: datetime.date | None = None,
+    end: datetime.date | None = None,
+    shop_id: int | None = None,
+):
+    """Restrict a query to reservations starting in [start, end] of a shop"""
+    if start is not None:
+        query = query.where(
+            Reservation.start_time >= datetime.datetime.combine(start, datetime.time())
+        )
+    if end is not None:
+        query = query.where(
+            Reservation.start_time
+            < datetime.datetime.combine(
+                end + datetime.timedelta(days=1), datetime.time()
+            )
+        )
+    if shop_id is not None:
+        query = query.where(Reservation.shop_id == shop_id)
+    return query
+
+
+def reservation_rows():
+    """Reservations joined with their shop and user, fetched in chunks"""
+    return (
+        select(
+            Shop.name,
+            User.full_name,
+            User.email,
+            User.group,
+            User.admin,
+            Reservation.start_time,
+            Reservation.end_time,
+        )
+        .join(Shop, Reservation.shop_id == Shop.id)
+        .join(User, Reservation.user_id == User.id)
+        .order_by(Reservation.start_time)
+        .order_by(Reservation.shop_id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+
+
+def stream_csv() -> Iterator[str]:
+    """Yield the reservations CSV chunk by chunk, in constant memory"""
+    writer = csv.writer(_Line())
+    yield writer.writerow(CSV_COLUMNS)
+
+    with SessionLock() as session:
+        result = session.exec(reservation_rows())
+        for rows in result.partitions():
+            yield "".join(
+                writer.writerow(
+                    [
+                        shop_name,
+                        user_name,
+                        user_email,
+                        user_group,
+                        user_admin,
+                        start_time,
+                        (end_time - start_time).total_seconds() / (60 * 60),
+                    ]
+                )
+                for (
+                    shop_name,
+                    user_name,
+                    user_email,
+                    user_group,
+                    user_admin,
+                    start_time,
+                    end_time,
+                ) in rows
+            )
+
+
+def columnar_rows(
+    start: datetime.date | None = None,
+    end: datetime.date | None = None,
+    shop_id: int | None = None,
+):
+    """Reservations joined with their user, shop and time slot, fetched in chunks
+
+    Reservations spanning several slots have no time slot, its columns are null.
+    """
+    query = (
+        select(
+            Reservation.id,
+            Shop.id,
+            Shop.name,
+            User.id,
+            User.full_name,
+            User.email,
+            User.group,
+            User.admin,
+            Reservation.start_time,
+            Reservation.end_time,
+            Reservation.validated,
+            TimeSlot.id,
+            TimeSlot.day,
+            TimeSlot.start_time,
+            TimeSlot.end_time,
+            TimeSlot.max_volunteers,
+        )
+        .join(Shop, Reservation.shop_id == Shop.id)
+        .join(User, Reservation.user_id == User.id)
+        .outerjoin(TimeSlot, Reservation.time_slot_id == TimeSlot.id)
+        .order_by(Reservation.start_time)
+        .order_by(Reservation.shop_id)
+        .execution_options(yield_per=EXPORT_CHUNK_SIZE)
+    )
+    return _filtered(query, start, end, shop_id)
+
+
+class _Sink:
+    """Write-only file collecting what the parquet writer flushes"""
+
+    def __init__(self):
+        self.chunks: list[bytes] = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self.chunks.append(bytes(data))
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def flush(self) -> None:
+        pass
+
+    def close(self) -> None:
+        self.closed = True
+
+    def drain(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks.clear()
+        return data
+
+
+def stream_parquet(
+    start: datetime.date | None = None,
+    end: datetime.date | None = None,
+    shop_id: int | None = None,
+) -> Iterator[bytes]:
+    """Yield a Parquet file of the reservations, one row group per chunk
+
+    pyarrow is an optional dependency (`export` extra), a 501 is raised
+    before anything is sent if it is missing.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise HTTPException(status_code=501, detail="error.export.unavailable")
+
+    # Same order as columnar_rows(), plus the computed duration
+    schema = pa.schema(
+        [
+            ("reservation_id", pa.int64()),
+            ("shop_id", pa.int64()),
+            ("shop_name", pa.string()),
+            ("user_id", pa.int64()),
+            ("user_name", pa.string()),
+            ("user_email", pa.string()),
+            ("user_group", pa.string()),
+            ("user_admin", pa.bool_()),
+            ("start_time", pa.timestamp("s")),
+            ("end_time", pa.timestamp("s")),
+            ("validated", pa.bool_()),
+            ("time_slot_id", pa.int64()),
+            ("slot_day", pa.int8()),
+            ("slot_start_time", pa.time32("s")),
+            ("slot_end_time", pa.time32("s")),
+            ("slot_max_volunteers", pa.int64()),
+            ("duration_minutes", pa.int64()),
+        ]
+    )
+
+    def to_batch(rows):
+        columns = [list(column) for column in zip(*rows)]
+        columns.append(
+            [
+                int((end_time - start_time).total_seconds() // 60)
+                for start_time, end_time in zip(columns[8], columns[9])
+            ]
+        )
+        return pa.record_batch(
+            [pa.array(column, field.type) for column, field in zip(columns, schema)],
+            schema=schema,
+        )
+
+    def generate() -> Iterator[bytes]:
+        sink = _Sink()
+        with pq.ParquetWriter(pa.PythonFile(sink, mode="w"), schema) as writer:
+            with SessionLock() as session:
+                result = session.exec(columnar_rows(start, end, shop_id))
+                for rows in result.partitions():
+                    writer.write_batch(to_batch(rows))
+                    yield sink.drain()
+        yield sink.drain()
+
+    return generate()
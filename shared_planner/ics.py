@@ -1,8 +1,26 @@
+from collections.abc import Iterable, Iterator
 from datetime import datetime, timedelta, timezone
 import pytz
 
 
-def create_ics(
+VTIMEZONE = """BEGIN:VTIMEZONE
+TZID:Europe/Paris
+BEGIN:STANDARD
+DTSTART:20201025T030000
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10
+TZOFFSETFROM:+0200
+TZOFFSETTO:+0100
+END:STANDARD
+BEGIN:DAYLIGHT
+DTSTART:20200329T020000
+RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3
+TZOFFSETFROM:+0100
+TZOFFSETTO:+0200
+END:DAYLIGHT
+END:VTIMEZONE"""
+
+
+def create_event(
     event_name: str,
     start_time: str,  # yyyy-mm-dd hh:mm
     duration_minutes: int,
@@ -13,7 +31,7 @@ def create_ics(
     cancel: bool = False,
     update: bool = False,
 ) -> str:
-    """Create an iCalendar file for an event"""
+    """Create the VEVENT of an event"""
 
     # Parse the start time
     start_time = datetime.strptime(start_time, "%Y-%m-%d %H:%M")
@@ -49,34 +67,12 @@ def create_ics(
     if cancel:
         sequence = 2
 
-    # Create the iCalendar content
-    method = "PUBLISH" if (not update and not cancel) else "REQUEST"
     status = "CANCELLED" if cancel else "CONFIRMED"
     start_time_str = start_time.strftime(f"{dt_format}Z")
     end_time_str = end_time.strftime(f"{dt_format}Z")
     now_str = datetime.now().strftime(f"{dt_format}Z")
 
-    return f"""BEGIN:VCALENDAR
-VERSION:2.0
-PRODID:-//LiteApp//SharedPlanner//EN
-METHOD:{method}
-X-WR-TIMEZONE:Europe/Paris
-BEGIN:VTIMEZONE
-TZID:Europe/Paris
-BEGIN:STANDARD
-DTSTART:20201025T030000
-RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=10
-TZOFFSETFROM:+0200
-TZOFFSETTO:+0100
-END:STANDARD
-BEGIN:DAYLIGHT
-DTSTART:20200329T020000
-RRULE:FREQ=YEARLY;BYDAY=-1SU;BYMONTH=3
-TZOFFSETFROM:+0100
-TZOFFSETTO:+0200
-END:DAYLIGHT
-END:VTIMEZONE
-BEGIN:VEVENT
+    return f"""BEGIN:VEVENT
 UID:{id}@liteapp.fr
 DTSTAMP:{now_str}
 DTSTART:{start_time_str}
@@ -87,5 +83,79 @@ LOCATION:{location}
 ORGANIZER;CN={organizer_name}:MAILTO:{organizer_email}
 STATUS:{status}
 SEQUENCE:{sequence}
-END:VEVENT
+END:VEVENT"""
+
+
+def create_calendar(events: list[dict]) -> str:
+    """Create an iCalendar file holding several events (create_event arguments)"""
+    # Updates and cancellations must be applied by the calendar, not just shown
+    method = (
+        "REQUEST"
+        if any(event.get("update") or event.get("cancel") for event in events)
+        else "PUBLISH"
+    )
+    vevents = "\n".join(create_event(**event) for event in events)
+
+    return f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//LiteApp//SharedPlanner//EN
+METHOD:{method}
+X-WR-TIMEZONE:Europe/Paris
+{VTIMEZONE}
+{vevents}
 END:VCALENDAR"""
+
+
+def create_ics(**event) -> str:
+    """Create an iCalendar file for an event"""
+    return create_calendar([event])
+
+
+def escape(text: str) -> str:
+    """Escape a TEXT value of an iCalendar property"""
+    return (
+        text.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\n", "\\n")
+    )
+
+
+def feed_event(
+    id: int,
+    summary: str,
+    start_time: datetime,
+    end_time: datetime,
+    description: str,
+    location: str,
+    stamp: str,
+) -> str:
+    """VEVENT of a subscription feed, in local time (see VTIMEZONE)
+
+    The UID is the one of the mail invitations, clients merge both.
+    """
+    return f"""BEGIN:VEVENT
+UID:{id}@liteapp.fr
+DTSTAMP:{stamp}
+DTSTART;TZID=Europe/Paris:{start_time.strftime("%Y%m%dT%H%M%S")}
+DTEND;TZID=Europe/Paris:{end_time.strftime("%Y%m%dT%H%M%S")}
+SUMMARY:{escape(summary)}
+DESCRIPTION:{escape(description)}
+LOCATION:{escape(location)}
+STATUS:CONFIRMED
+END:VEVENT
+"""
+
+
+def stream_feed(name: str, events: Iterable[str]) -> Iterator[str]:
+    """Yield a subscription calendar made of already built VEVENTs"""
+    yield f"""BEGIN:VCALENDAR
+VERSION:2.0
+PRODID:-//LiteApp//SharedPlanner//EN
+METHOD:PUBLISH
+X-WR-CALNAME:{escape(name)}
+X-WR-TIMEZONE:Europe/Paris
+{VTIMEZONE}
+"""
+    yield from events
+    yield "END:VCALENDAR\n"
@@ -1,21 +1,36 @@
 from email.policy import SMTP
 import json
 import os
+import socket
+import sys
 import time
 import threading
-from queue import Queue
-from datetime import datetime
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
 import locale
 from dotenv import load_dotenv
-import smtplib
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.image import MIMEImage
-from shared_planner.db.models import Setting, Reservation, Notification, User
+from sqlmodel import not_, update
+from shared_planner.db.models import (
+    ADMINS_VERSION_KEY,
+    Counter,
+    Lease,
+    MailOutbox,
+    Setting,
+    Reservation,
+    Notification,
+    User,
+)
 from shared_planner.db.settings import get
 from shared_planner.db.session import SessionLock
 from shared_planner.week import monday_str
-from shared_planner.ics import create_ics
+from shared_planner.ics import create_calendar
+from shared_planner.reminders import ReminderSchedule
+from shared_planner.smtp import RateLimiter, SMTPPool
+from shared_planner.templating import templates
 
 # Load environment variables from .env file
 load_dotenv()
@@ -25,7 +40,23 @@ SMTP_PORT = int(os.getenv("SMTP_PORT", 587))
 SMTP_USER = os.getenv("SMTP_USER")
 SMTP_USE_TLS = os.getenv("SMTP_USE_TLS", "false").lower() in ("true", "1", "y", "yes")
 SMTP_PASSWORD = os.getenv("SMTP_PASSWORD")
-TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "..", "templates")
+SMTP_POOL_SIZE = int(os.getenv("SMTP_POOL_SIZE", 4))
+MAIL_CONCURRENCY = int(os.getenv("MAIL_CONCURRENCY", 4))
+MAIL_RATE_LIMIT = float(os.getenv("MAIL_RATE_LIMIT", 10))  # Mails per second, 0 = none
+MAIL_BATCH_SIZE = int(os.getenv("MAIL_BATCH_SIZE", 100))
+MAIL_MAX_ATTEMPTS = int(os.getenv("MAIL_MAX_ATTEMPTS", 5))
+MAIL_RETRY_DELAY = float(os.getenv("MAIL_RETRY_DELAY", 30))  # Doubled at each failure
+# How long a claimed batch is reserved to a mailer before others can retry it
+MAIL_CLAIM_DURATION = timedelta(seconds=int(os.getenv("MAIL_CLAIM_SECONDS", 300)))
+
+# Only the process holding this lease schedules the reminders, every mailer sends
+LEASE_NAME = "mailer"
+LEASE_DURATION = timedelta(seconds=int(os.getenv("MAILER_LEASE_SECONDS", 30)))
+MAILER_ID = f"{socket.gethostname()}:{os.getpid()}"
+# Pause after an error of the mailer loop (e.g. database locked), doubled while
+# it keeps failing
+MAILER_ERROR_DELAY = float(os.getenv("MAILER_ERROR_DELAY", 5))  # Seconds
+MAILER_MAX_ERROR_DELAY = float(os.getenv("MAILER_MAX_ERROR_DELAY", 300))  # Seconds
 
 SUBJECTS = {
     "password_reset": "[MAGEV] Réinitialisation de mot de passe",
@@ -40,109 +71,190 @@ SUBJECTS = {
     "notification.admin.reservation_modified": "[ADMIN] Modification de réservation",
     "notification.admin.reservation_cancelled": "[ADMIN] Annulation de réservation",
     "notification.admin.new_user": "[ADMIN] Nouvel utilisateur",
+    "digest": "[MAGEV] Récapitulatif de vos notifications",
+    "digest.admin": "[ADMIN] Récapitulatif des notifications",
 }
 
-with open(os.path.join(TEMPLATE_DIR, "mail_shell.html"), "r") as file:
-    MAIL_BASE = file.read()
+templates.load_all()
 
 
-mail_queue = Queue()
+smtp_pool = SMTPPool(
+    SMTP_SERVER, SMTP_PORT, SMTP_USER, SMTP_PASSWORD, SMTP_USE_TLS, SMTP_POOL_SIZE
+)
+rate_limiter = RateLimiter(MAIL_RATE_LIMIT, burst=MAIL_CONCURRENCY)
+reminder_schedule = ReminderSchedule()
+executor = ThreadPoolExecutor(MAIL_CONCURRENCY, thread_name_prefix="mailer")
 # Set locale to French
 locale.setlocale(locale.LC_TIME, "fr_FR.UTF-8")
 
 
-def d(value, format_type="date"):
-    dt = datetime.strptime(value, "%Y-%m-%d %H:%M")
-    if format_type == "date":
-        return dt.strftime("%d %B %Y")
-    elif format_type == "time":
-        return dt.strftime("%H:%M")
-    elif format_type == "datetime":
-        return dt.strftime("%d %B %Y %H:%M")
-    elif format_type == "long":
-        return dt.strftime("%A %d %B %Y %H:%M")
-    elif format_type == "short":
-        return dt.strftime("%d/%m/%Y %H:%M")
-    else:
-        return value
+class AdminRecipients:
+    """Names and emails of the admins, reloaded when ADMINS_VERSION_KEY changes"""
 
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._version: int | None = None
+        self._admins: list[tuple[str, str]] = []
 
-def send_mail(name: str, email: str, template: str, data: dict):
-    subject = SUBJECTS.get(template, "Notification")
+    def get(self) -> list[tuple[str, str]]:
+        with self._lock, SessionLock() as session:
+            version = Counter.read(session, ADMINS_VERSION_KEY)
+            if version != self._version:
+                self._admins = [
+                    (admin.full_name, admin.email) for admin in User.get_admins(session)
+                ]
+                self._version = version
+            return self._admins
 
-    template = template.replace(".", os.sep)
-    with open(os.path.join(TEMPLATE_DIR, template) + ".html", "r") as file:
-        template_content = file.read()
-
-    for key, value in data.items():
-        if key.startswith("date-"):
-            value = d(value)
-        elif key.startswith("time-"):
-            value = d(value, "time")
-        elif key.startswith("datetime-"):
-            value = d(value, "datetime")
-        elif key.startswith("datetime_long-"):
-            value = d(value, "long")
-        elif key.startswith("datetime_short-"):
-            value = d(value, "short")
-        elif key.endswith("duration"):
-            hours = int(value // 60)
-            minutes = value % 60
-            value = (f"{hours}h" if hours > 0 else "") + (
-                f"{minutes}min" if minutes > 0 else ""
-            )
-        template_content = template_content.replace(f"{{{key}}}", str(value))
 
-    template_content = template_content.replace(
-        "{base_domain}", get("base_domain").value
-    ).replace("{admin_mail}", get("admin_mail").value)
+admin_recipients = AdminRecipients()
 
-    template_content = (
-        MAIL_BASE.replace("{content}", template_content)
-        .replace("{base_domain}", get("base_domain").value)
-        .replace("{admin_mail}", get("admin_mail").value)
-    )
 
+def _assemble(
+    to: list[tuple[str, str]],
+    subject: str,
+    content: str,
+    events: list[dict],
+) -> MIMEMultipart:
     msg = MIMEMultipart()
     msg["From"] = get("mail_from").value
-    msg["To"] = f"{name} <{email}>"
+    msg["To"] = ", ".join(f"{name} <{email}>" for name, email in to)
     msg["Subject"] = subject
 
-    # If the data contains an ICS event, create the ICS file and attach it to the email
-    if "ics" in data:
-        ics_content = create_ics(**data["ics"])
-        ics = MIMEText(ics_content, "calendar; method=REQUEST")
+    # Attach the ICS events of the mail as a single calendar file
+    if events:
+        ics = MIMEText(create_calendar(events), "calendar; method=REQUEST")
         ics.add_header("Content-Disposition", "attachment; filename=invitation.ics")
         msg.attach(ics)
 
-    msg.attach(MIMEText(template_content, "html"))
+    msg.attach(MIMEText(content, "html"))
+    return msg
+
+
+def _shared_values() -> dict:
+    return {
+        "base_domain": get("base_domain").value,
+        "admin_mail": get("admin_mail").value,
+    }
+
+
+def build_mail(to: list[tuple[str, str]], template: str, data: dict) -> MIMEMultipart:
+    subject = SUBJECTS.get(template, "Notification")
+    content = templates.render(template, {**data, **_shared_values()})
+    return _assemble(to, subject, content, [data["ics"]] if "ics" in data else [])
+
+
+def build_digest(
+    to: list[tuple[str, str]], items: list[tuple[str, dict]]
+) -> MIMEMultipart:
+    """One mail made of several notifications, their ICS events merged"""
+    admin = all(template.startswith("notification.admin.") for template, _ in items)
+    subject = SUBJECTS["digest.admin" if admin else "digest"]
+    content = templates.render_digest(items, _shared_values())
+    return _assemble(
+        to, subject, content, [data["ics"] for _, data in items if "ics" in data]
+    )
+
 
+def _send(to: list[tuple[str, str]], msg: MIMEMultipart) -> None:
+    """Send a mail to every recipient in a single SMTP transaction"""
+    emails = [email for _, email in to]
     if get("block_all_emails").asBool():
-        print(f"Email to {email} blocked by setting")
+        print(f"Email to {', '.join(emails)} blocked by setting")
         return
 
+    smtp_pool.send(SMTP_USER, emails, msg.as_string())
+    print(f"Email sent to {', '.join(emails)}")
+
+
+def deliver_mail(name: str, email: str, template: str, data: dict) -> None:
+    """Render and send a mail through the connection pool, raises on failure"""
+    to = [(name, email)]
+    _send(to, build_mail(to, template, data))
+
+
+def send_mail(name: str, email: str, template: str, data: dict):
     try:
-        with smtplib.SMTP(SMTP_SERVER, SMTP_PORT) as server:
-            if SMTP_USE_TLS:
-                server.starttls()
-            server.login(SMTP_USER, SMTP_PASSWORD)
-            server.sendmail(SMTP_USER, email, msg.as_string())
-            print(f"Email sent to {email}")
+        deliver_mail(name, email, template, data)
     except Exception as e:
         print(f"Failed to send email to {email}: {e}")
 
 
-def queue_mail(name, email, template, data):
-    mail_queue.put((name, email, template, data))
+def _deliver_claimed(mails: list[MailOutbox]) -> None:
+    """Send mails claimed for the same recipient, as a digest if several
+
+    Admin mails are rendered once and sent to all the admins at once.
+    """
+    if mails[0].admins:
+        to = admin_recipients.get()
+    else:
+        to = [(mails[0].name, mails[0].email)]
+    email = ", ".join(email for _, email in to)
+    rate_limiter.wait()
+    try:
+        if len(mails) == 1:
+            msg = build_mail(to, mails[0].template, json.loads(mails[0].data))
+        else:
+            items = [(mail.template, json.loads(mail.data)) for mail in mails]
+            msg = build_digest(to, items)
+        if to:  # There may be no admin
+            _send(to, msg)
+    except Exception as e:
+        with SessionLock() as session:
+            if MailOutbox.mark_failed(
+                session, mails, str(e), MAIL_MAX_ATTEMPTS, MAIL_RETRY_DELAY
+            ):
+                print(f"Failed to send email to {email}, will retry: {e}")
+            else:
+                print(f"Failed to send email to {email}, giving up: {e}")
+        return
+    with SessionLock() as session:
+        MailOutbox.mark_sent(session, mails)
+
+
+def deliver_batch() -> int:
+    """Claim up to MAIL_BATCH_SIZE mails of the outbox and send them concurrently
+
+    The digest mails of a recipient are grouped, oldest first.
+    """
+    with SessionLock() as session:
+        batch = MailOutbox.claim_batch(session, MAIL_BATCH_SIZE, MAIL_CLAIM_DURATION)
+    groups: list[list[MailOutbox]] = []
+    digests: dict[tuple[bool, str], list[MailOutbox]] = {}
+    for mail in sorted(batch, key=lambda mail: mail.created_at):
+        recipient = (mail.admins, mail.email)
+        if not mail.digest:
+            groups.append([mail])
+        elif recipient in digests:
+            digests[recipient].append(mail)
+        else:
+            digests[recipient] = [mail]
+            groups.append(digests[recipient])
+    list(executor.map(_deliver_claimed, groups))
+    return len(batch)
 
 
 def queue_reminders():
     email_notification_before = get("email_notification_before").asInt()
     if email_notification_before == -1:
         return
+    now = datetime.now()
     with SessionLock() as session:
-        to_send = Reservation.find_unsent_reminders(session, email_notification_before)
+        reminder_schedule.refresh(session, email_notification_before, now)
+        due = reminder_schedule.due(now)
+        if not due:
+            return
+        to_send = Reservation.find_unsent_reminders(session, due)
         for reservation in to_send:
+            claimed = session.exec(
+                update(Reservation)
+                .where(
+                    Reservation.id == reservation.id, not_(Reservation.reminder_sent)
+                )
+                .values(reminder_sent=True)
+            ).rowcount
+            if not claimed:
+                continue  # Already handled by another mailer
             session.add(
                 Notification.create(
                     user=reservation.user,
@@ -164,70 +276,55 @@ def queue_reminders():
                     mail=True,
                 )
             )
-            reservation.reminder_sent = True
-            session.add(reservation)
-        session.commit()
-
-
-def queue_notifications():
-    with SessionLock() as session:
-        unsent = Notification.find_unsent(session)
-        # Group notifications by user
-        notifications = {}
-        for notification in unsent:
-            if notification.user_id not in notifications:
-                notifications[notification.user_id] = []
-            notifications[notification.user_id].append(notification)
-        for user_id, user_notifications in notifications.items():
-            if user_id is None:
-                continue
-            user = session.get(User, user_id)
-            for notification in user_notifications:
-                data = json.loads(notification.data) if notification.data else {}
-                if notification.route:
-                    data["route"] = notification.route
-                queue_mail(
-                    user.full_name,
-                    user.email,
-                    notification.message,
-                    data,
-                )
-                notification.mail_sent = True
-                session.add(notification)
-            session.commit()
-        admin_mails = notifications.get(None, [])
-        for notification in admin_mails:
-            data = json.loads(notification.data) if notification.data else {}
-            if notification.route:
-                data["route"] = notification.route
-            for admin in User.get_admins(session):
-                queue_mail(
-                    admin.full_name,
-                    admin.email,
-                    notification.message,
-                    data,
-                )
-            notification.mail_sent = True
-            session.add(notification)
         session.commit()
+    # Only now, so that they are tried again if anything above failed
+    reminder_schedule.done(due)
 
 
 def stop_mailer_daemon():
     global daemon_running
     daemon_running = False
     daemon_thread.join()
+    smtp_pool.close()
+    with SessionLock() as session:
+        Lease.release(session, LEASE_NAME, MAILER_ID)
 
 
-def mailer_daemon():
-    while daemon_running:
-        if not mail_queue.empty():
-            name, email, template, data = mail_queue.get()
-            if data is None:
-                data = {}
-            send_mail(name, email, template, data)
+def renew_lease(lease_until: datetime | None) -> datetime | None:
+    """Acquire or renew the mailer lease once half of it has elapsed"""
+    if lease_until is not None and lease_until - datetime.now() > LEASE_DURATION / 2:
+        return lease_until
+    with SessionLock() as session:
+        return Lease.acquire(session, LEASE_NAME, MAILER_ID, LEASE_DURATION)
+
+
+def mailer_step(lease_until: datetime | None) -> datetime | None:
+    """Send a batch of the outbox and, with the lease, queue the reminders"""
+    if deliver_batch() < MAIL_BATCH_SIZE:
         time.sleep(get("email_daemon_delay").asInt())
+    lease_until = renew_lease(lease_until)
+    if lease_until is not None:  # Else another mailer schedules the reminders
         queue_reminders()
-        queue_notifications()
+    return lease_until
+
+
+def mailer_daemon():
+    """Run mailer_step until stopped, an error only pauses the loop
+
+    Claimed mails that were not marked are retried once their claim expires.
+    """
+    lease_until = None
+    failures = 0
+    while daemon_running:
+        try:
+            lease_until = mailer_step(lease_until)
+            failures = 0
+        except Exception:
+            delay = min(MAILER_ERROR_DELAY * 2**failures, MAILER_MAX_ERROR_DELAY)
+            failures += 1
+            print(f"Mailer error, retrying in {delay:g}s:", file=sys.stderr)
+            traceback.print_exc()
+            time.sleep(delay)
 
 
 def start_mailer_daemon():
@@ -239,21 +336,21 @@ def start_mailer_daemon():
 
 def main():
     start_mailer_daemon()
-    # Keep the main thread alive
-    while True:
-        time.sleep(1)
+    # Keep the main thread alive, and exit with an error if the daemon died
+    while daemon_thread.is_alive():
+        daemon_thread.join(1)
+    print("Mailer daemon stopped unexpectedly", file=sys.stderr)
+    sys.exit(1)
 
 
 def serve_mail():
     from http.server import BaseHTTPRequestHandler, HTTPServer
-    import sys
 
     if len(sys.argv) < 2:
         print("Usage: python mailer_daemon.py <template> <data>")
         sys.exit(1)
 
     template = sys.argv[1]
-    template = template.replace(".", os.sep)
     data = {}
     for arg in sys.argv[2:]:
         key, value = arg.split("=")
@@ -264,14 +361,15 @@ def serve_mail():
             self.send_response(200)
             self.send_header("Content-type", "text/html")
             self.end_headers()
-            with open(os.path.join(TEMPLATE_DIR, template) + ".html", "r") as file:
-                template_content = file.read()
-            for key, value in data.items():
-                template_content = template_content.replace(f"{{{key}}}", str(value))
-            template_content = MAIL_BASE.replace("{content}", template_content)
-            template_content = template_content.replace(
-                "{base_domain}", get("base_domain").value
-            ).replace("{admin_mail}", get("admin_mail").value)
+            template_content = templates.render(
+                template,
+                {
+                    **data,
+                    "base_domain": get("base_domain").value,
+                    "admin_mail": get("admin_mail").value,
+                },
+                apply_filters=False,
+            )
             self.wfile.write(template_content.encode())
 
         def log_message(self, format, *args):
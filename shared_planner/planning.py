@@ -0,0 +1,253 @@
+import bisect
+import datetime
+from collections import defaultdict
+from collections.abc import Iterable
+
+from fastapi import HTTPException
+from sqlmodel import delete, select, update
+
+from shared_planner.db.models import Event, Reservation, SlotOccupancy, TimeSlot
+from shared_planner.db.session import SessionLock, insert_ignore
+
+
+def slot_bounds(
+    slot: TimeSlot, date: datetime.date
+) -> tuple[datetime.datetime, datetime.datetime]:
+    """Return the start and end of a recurring slot on a given date"""
+    return (
+        datetime.datetime.combine(date, slot.start_time),
+        datetime.datetime.combine(date, slot.end_time),
+    )
+
+
+class OccupancyIndex:
+    """Sorted index over reservations answering overlap queries in O(log n)"""
+
+    def __init__(self, reservations: list[Reservation]):
+        self._starts = sorted(r.start_time for r in reservations)
+        self._ends = sorted(r.end_time for r in reservations)
+        self._by_user: dict[int, list[Reservation]] = defaultdict(list)
+        for reservation in reservations:
+            self._by_user[reservation.user_id].append(reservation)
+
+    def count(self, start: datetime.datetime, end: datetime.datetime) -> int:
+        """Number of reservations overlapping [start, end)"""
+        # Every reservation that ended before `start` also started before `end`
+        return bisect.bisect_left(self._starts, end) - bisect.bisect_right(
+            self._ends, start
+        )
+
+    def find(
+        self, user_id: int, start: datetime.datetime, end: datetime.datetime
+    ) -> Reservation | None:
+        """Reservation of a user overlapping [start, end), if any"""
+        for reservation in self._by_user.get(user_id, ()):
+            if reservation.start_time < end and reservation.end_time > start:
+                return reservation
+        return None
+
+
+class WeekPlanning:
+    """Slots of a shop for one week with their occupancy counters
+
+    `index` only holds the reservations of the user the planning is built for.
+    """
+
+    def __init__(
+        self,
+        week_start: datetime.datetime,
+        slots: list[TimeSlot],
+        occupancies: list[SlotOccupancy],
+        user_reservations: list[Reservation],
+    ):
+        self.week_start = week_start
+        self.index = OccupancyIndex(user_reservations)
+        self._booked = {(o.time_slot_id, o.date): o.booked for o in occupancies}
+        self._slots_by_day: dict[int, list[TimeSlot]] = defaultdict(list)
+        for slot in sorted(slots, key=lambda s: s.start_time):
+            self._slots_by_day[slot.day].append(slot)
+
+    def days(self):
+        """Yield (date, active slots sorted by start time) for each day of the week"""
+        for day_offset in range(7):
+            day_date = (self.week_start + datetime.timedelta(days=day_offset)).date()
+            yield (
+                day_date,
+                [
+                    slot
+                    for slot in self._slots_by_day.get(day_date.weekday(), ())
+                    if slot.valid_from <= day_date <= slot.valid_until
+                ],
+            )
+
+    def booked(self, slot: TimeSlot, date: datetime.date) -> int:
+        return self._booked.get((slot.id, date), 0)
+
+
+def reservations_between(
+    session: SessionLock,
+    shop_id: int,
+    start: datetime.datetime,
+    end: datetime.datetime,
+    user_id: int | None = None,
+) -> list[Reservation]:
+    """Reservations of a shop (and optionally of a user) starting in [start, end)"""
+    query = select(Reservation).where(
+        Reservation.shop_id == shop_id,
+        Reservation.start_time >= start,
+        Reservation.start_time < end,
+    )
+    if user_id is not None:
+        query = query.where(Reservation.user_id == user_id)
+    return session.exec(query).all()
+
+
+def load_week(
+    session: SessionLock, shop_id: int, week_start: datetime.datetime, user_id: int
+) -> WeekPlanning:
+    week_end = week_start + datetime.timedelta(days=7)
+    slots = session.exec(
+        select(TimeSlot).where(
+            TimeSlot.shop_id == shop_id,
+            TimeSlot.valid_from < week_end.date(),
+            TimeSlot.valid_until >= week_start.date(),
+        )
+    ).all()
+    occupancies = session.exec(
+        select(SlotOccupancy).where(
+            SlotOccupancy.time_slot_id.in_([slot.id for slot in slots]),
+            SlotOccupancy.date >= week_start.date(),
+            SlotOccupancy.date < week_end.date(),
+        )
+    ).all()
+    return WeekPlanning(
+        week_start,
+        slots,
+        occupancies,
+        reservations_between(session, shop_id, week_start, week_end, user_id),
+    )
+
+
+def load_day(
+    session: SessionLock, shop_id: int, date: datetime.date, user_id: int | None = None
+) -> OccupancyIndex:
+    day_start = datetime.datetime.combine(date, datetime.time())
+    return OccupancyIndex(
+        reservations_between(
+            session, shop_id, day_start, day_start + datetime.timedelta(days=1), user_id
+        )
+    )
+
+
+def booked_count(session: SessionLock, slot: TimeSlot, date: datetime.date) -> int:
+    occupancy = session.get(SlotOccupancy, (slot.id, date))
+    return occupancy.booked if occupancy is not None else 0
+
+
+def _overlapping_slots(
+    session: SessionLock, reservation: Reservation
+) -> list[TimeSlot]:
+    date = reservation.start_time.date()
+    slots = session.exec(
+        select(TimeSlot).where(
+            TimeSlot.shop_id == reservation.shop_id,
+            TimeSlot.day == date.weekday(),
+            TimeSlot.valid_from <= date,
+            TimeSlot.valid_until >= date,
+        )
+    ).all()
+    result = []
+    for slot in slots:
+        slot_start, slot_end = slot_bounds(slot, date)
+        if reservation.start_time < slot_end and reservation.end_time > slot_start:
+            result.append(slot)
+    return result
+
+
+def _add_booked(
+    session: SessionLock,
+    slot_id: int,
+    date: datetime.date,
+    delta: int,
+    capacity: int | None = None,
+) -> bool:
+    """Atomically change a counter, refusing to go over `capacity` if given"""
+    if delta > 0:
+        insert_ignore(session, SlotOccupancy, time_slot_id=slot_id, date=date, booked=0)
+    query = (
+        update(SlotOccupancy)
+        .where(SlotOccupancy.time_slot_id == slot_id, SlotOccupancy.date == date)
+        .values(booked=SlotOccupancy.booked + delta)
+    )
+    if capacity is not None:
+        query = query.where(SlotOccupancy.booked + delta <= capacity)
+    return session.exec(query).rowcount > 0
+
+
+def _publish_booked(
+    session: SessionLock, shop_id: int, slot_id: int, date: datetime.date
+) -> None:
+    """Push the new counter of a slot to the clients viewing the shop"""
+    booked = session.exec(
+        select(SlotOccupancy.booked).where(
+            SlotOccupancy.time_slot_id == slot_id, SlotOccupancy.date == date
+        )
+    ).first()
+    Event.publish(
+        session,
+        f"shop:{shop_id}",
+        "booked",
+        {"slot_id": slot_id, "date": date.isoformat(), "booked_count": booked or 0},
+    )
+
+
+def occupy(
+    session: SessionLock,
+    reservation: Reservation,
+    capacity_checked: Iterable[TimeSlot] = (),
+) -> None:
+    """Count a new reservation in the occupancy of every slot it overlaps
+
+    The counters of the `capacity_checked` slots are only incremented while
+    below `max_volunteers`, in a single conditional UPDATE, so concurrent
+    bookings cannot overbook them. The caller must roll back on error.
+    """
+    session.flush()  # Foreign keys set through relationships are only known once flushed
+    date = reservation.start_time.date()
+    capacities = {slot.id: slot.max_volunteers for slot in capacity_checked}
+    for slot in _overlapping_slots(session, reservation):
+        if not _add_booked(session, slot.id, date, 1, capacities.get(slot.id)):
+            raise HTTPException(status_code=400, detail="error.reservation.overlap")
+        _publish_booked(session, reservation.shop_id, slot.id, date)
+
+
+def release(session: SessionLock, reservation: Reservation) -> None:
+    """Remove a reservation about to be deleted from the slot occupancies"""
+    date = reservation.start_time.date()
+    for slot in _overlapping_slots(session, reservation):
+        _add_booked(session, slot.id, date, -1)
+        _publish_booked(session, reservation.shop_id, slot.id, date)
+
+
+def rebuild_occupancy(session: SessionLock, slot: TimeSlot) -> None:
+    """Recompute the counters of a slot from its reservations (new or edited slot)"""
+    session.exec(delete(SlotOccupancy).where(SlotOccupancy.time_slot_id == slot.id))
+
+    reservations = reservations_between(
+        session,
+        slot.shop_id,
+        datetime.datetime.combine(slot.valid_from, datetime.time()),
+        datetime.datetime.combine(
+            slot.valid_until + datetime.timedelta(days=1), datetime.time()
+        ),
+    )
+    by_date: dict[datetime.date, list[Reservation]] = defaultdict(list)
+    for reservation in reservations:
+        if reservation.start_time.weekday() == slot.day:
+            by_date[reservation.start_time.date()].append(reservation)
+
+    for date, day_reservations in by_date.items():
+        booked = OccupancyIndex(day_reservations).count(*slot_bounds(slot, date))
+        if booked > 0:
+            session.add(SlotOccupancy(time_slot_id=slot.id, date=date, booked=booked))
+    session.flush()
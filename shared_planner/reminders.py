@@ -0,0 +1,107 @@
+import heapq
+import os
+import time
+from datetime import datetime, timedelta
+
+from shared_planner.db.models import REMINDERS_VERSION_KEY, Counter, Reservation
+from shared_planner.db.session import SessionLock
+
+# Reservations whose reminder is due within this window are kept in memory
+REMINDER_HORIZON = timedelta(hours=int(os.getenv("REMINDER_HORIZON_HOURS", 24)))
+# Reservations changed this long before the latest change seen are read again on
+# update, for the transactions that were still running when it was read
+REMINDER_RELOAD_OVERLAP = 60 * 1000  # Milliseconds
+
+
+class ReminderSchedule:
+    """Heap of the upcoming reminder due times of the reservations
+
+    The heap is loaded from the (reminder_sent, start_time) index for the next
+    REMINDER_HORIZON only, and reloaded once that horizon is reached or when
+    the reminder delay changes. When reservations are booked or moved
+    (REMINDERS_VERSION_KEY counter), only those are read again, from their
+    `changed_at` index. While nothing changes, a tick costs one counter read
+    and a look at the top of the heap.
+
+    Entries of moved reservations are left in the heap and skipped, cancelled
+    reservations are skipped when their reminder is due.
+    """
+
+    def __init__(self, horizon: timedelta = REMINDER_HORIZON):
+        self.horizon = horizon
+        self._heap: list[tuple[datetime, int]] = []  # (due time, reservation id)
+        self._due: dict[int, datetime] = {}  # Current due time of each reservation
+        self._version: int | None = None
+        self._hours_before: int | None = None
+        self._loaded_until = datetime.min
+        self._since = 0  # Changes (ms) before this one are already applied
+
+    def invalidate(self) -> None:
+        self._hours_before = None
+
+    def _schedule(self, id: int, due: datetime) -> None:
+        if self._due.get(id) != due:
+            self._due[id] = due
+            heapq.heappush(self._heap, (due, id))
+
+    def _clean(self) -> None:
+        """Drop the entries of moved or sent reminders from the top of the heap"""
+        while self._heap and self._due.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def _reload(self, session: SessionLock, hours_before: int, now: datetime) -> None:
+        before = timedelta(hours=hours_before)
+        self._since = int(time.time() * 1000) - REMINDER_RELOAD_OVERLAP
+        self._loaded_until = now + self.horizon
+        # Reservations already started get no reminder
+        self._due = {
+            id: start_time - before
+            for id, start_time in Reservation.upcoming_reminders(
+                session, now, self._loaded_until + before
+            )
+        }
+        self._heap = [(due, id) for id, due in self._due.items()]
+        heapq.heapify(self._heap)
+        self._hours_before = hours_before
+
+    def _update(self, session: SessionLock, now: datetime) -> None:
+        before = timedelta(hours=self._hours_before)
+        changes = Reservation.changed_since(session, self._since)
+        for id, start_time, reminder_sent, _ in changes:
+            due = start_time - before
+            if reminder_sent or start_time < now or due >= self._loaded_until:
+                self._due.pop(id, None)  # Back in the heap on the next reload
+            else:
+                self._schedule(id, due)
+        if changes:
+            latest = max(changed_at for *_, changed_at in changes)
+            self._since = max(self._since, latest - REMINDER_RELOAD_OVERLAP)
+
+    def refresh(self, session: SessionLock, hours_before: int, now: datetime) -> None:
+        version = Counter.read(session, REMINDERS_VERSION_KEY)
+        if hours_before != self._hours_before or now >= self._loaded_until:
+            self._reload(session, hours_before, now)
+        elif version != self._version:
+            self._update(session, now)
+        self._version = version
+
+    def next_due(self) -> datetime | None:
+        self._clean()
+        return self._heap[0][0] if self._heap else None
+
+    def due(self, now: datetime) -> list[int]:
+        """Ids of the reservations whose reminder is due, kept until `done`"""
+        entries = []
+        while self._heap and self._heap[0][0] <= now:
+            entries.append(heapq.heappop(self._heap))
+        for entry in entries:
+            heapq.heappush(self._heap, entry)
+        return list(
+            dict.fromkeys(id for due, id in entries if self._due.get(id) == due)
+        )
+
+    def done(self, ids: list[int]) -> None:
+        """Remove reminders from the schedule, once they are queued"""
+        for id in ids:
+            self._due.pop(id, None)
+        self._clean()
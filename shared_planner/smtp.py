@@ -0,0 +1,118 @@
+import smtplib
+import threading
+import time
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+
+
+class SMTPPool:
+    """Pool of authenticated SMTP connections reused between mails
+
+    Connections idle for longer than `max_idle` seconds are dropped instead of
+    being reused, since most servers close them on their side.
+    """
+
+    def __init__(
+        self,
+        server: str,
+        port: int,
+        user: str | None,
+        password: str | None,
+        use_tls: bool,
+        size: int = 4,
+        max_idle: float = 60,
+    ):
+        self.server = server
+        self.port = port
+        self.user = user
+        self.password = password
+        self.use_tls = use_tls
+        self.max_idle = max_idle
+        self._idle: LifoQueue[tuple[float, smtplib.SMTP]] = LifoQueue(maxsize=size)
+
+    def _open(self) -> smtplib.SMTP:
+        connection = smtplib.SMTP(self.server, self.port, timeout=30)
+        try:
+            if self.use_tls:
+                connection.starttls()
+            if self.user:
+                connection.login(self.user, self.password)
+        except Exception:
+            connection.close()
+            raise
+        return connection
+
+    @staticmethod
+    def _close(connection: smtplib.SMTP) -> None:
+        try:
+            connection.quit()
+        except Exception:
+            connection.close()
+
+    def _take(self) -> smtplib.SMTP:
+        while True:
+            try:
+                released_at, connection = self._idle.get_nowait()
+            except Empty:
+                return self._open()
+            if time.monotonic() - released_at < self.max_idle:
+                return connection
+            self._close(connection)
+
+    @contextmanager
+    def connection(self):
+        """Borrow a connection, it is discarded if the block raises"""
+        connection = self._take()
+        try:
+            yield connection
+        except Exception:
+            self._close(connection)
+            raise
+        try:
+            self._idle.put_nowait((time.monotonic(), connection))
+        except Exception:
+            self._close(connection)  # The pool is full
+
+    def send(self, from_addr: str, to_addrs: str | list[str], message: str) -> None:
+        try:
+            with self.connection() as connection:
+                connection.sendmail(from_addr, to_addrs, message)
+        except smtplib.SMTPServerDisconnected:
+            # The server dropped a pooled connection, retry once with a new one
+            with self.connection() as connection:
+                connection.sendmail(from_addr, to_addrs, message)
+
+    def close(self) -> None:
+        while True:
+            try:
+                _, connection = self._idle.get_nowait()
+            except Empty:
+                return
+            self._close(connection)
+
+
+class RateLimiter:
+    """Token bucket allowing `rate` operations per second (unlimited if <= 0)"""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def wait(self) -> None:
+        if self.rate <= 0:
+            return
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._tokens = min(
+                    self.burst, self._tokens + (now - self._updated) * self.rate
+                )
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                delay = (1 - self._tokens) / self.rate
+            time.sleep(delay)
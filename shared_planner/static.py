@@ -0,0 +1,147 @@
+import gzip
+import hashlib
+import mimetypes
+import os
+from pathlib import Path
+
+from fastapi import Request, Response
+from starlette.responses import FileResponse
+
+# Vite puts a content hash in the name of everything it writes there
+IMMUTABLE_PREFIX = "assets/"
+IMMUTABLE_CACHE_CONTROL = "public, max-age=31536000, immutable"
+# Served as is, browsers must check whether they changed (index.html, favicon)
+REVALIDATE_CACHE_CONTROL = "no-cache"
+# Encodings in order of preference, with the suffix of their precompressed file
+ENCODINGS = [("br", ".br"), ("gzip", ".gz")]
+COMPRESSIBLE_TYPES = (
+    "text/",
+    "application/javascript",
+    "application/json",
+    "application/manifest+json",
+    "application/xml",
+    "image/svg+xml",
+)
+GZIP_MIN_SIZE = 1024  # Bytes, smaller files are not worth compressing
+
+
+class _Variant:
+    """One encoding of a file, on disk or compressed in memory at startup"""
+
+    def __init__(
+        self,
+        etag: str,
+        path: Path | None = None,
+        stat: os.stat_result | None = None,
+        content: bytes | None = None,
+    ):
+        self.etag = etag
+        self.path = path
+        self.stat = stat
+        self.content = content
+
+
+class StaticAsset:
+    """A file of the built frontend with its precompressed variants"""
+
+    def __init__(self, path: Path, relative: str):
+        self.media_type = mimetypes.guess_type(path.name)[0] or "text/plain"
+        self.cache_control = (
+            IMMUTABLE_CACHE_CONTROL
+            if relative.startswith(IMMUTABLE_PREFIX)
+            else REVALIDATE_CACHE_CONTROL
+        )
+        data = path.read_bytes()
+        digest = hashlib.blake2b(data, digest_size=12).hexdigest()
+        self.variants: dict[str, _Variant] = {
+            "identity": _Variant(f'"{digest}"', path, path.stat())
+        }
+
+        for encoding, suffix in ENCODINGS:
+            compressed = path.with_name(path.name + suffix)
+            if compressed.is_file():
+                self.variants[encoding] = _Variant(
+                    f'"{digest}-{encoding}"', compressed, compressed.stat()
+                )
+        if (
+            "gzip" not in self.variants
+            and len(data) >= GZIP_MIN_SIZE
+            and self.media_type.startswith(COMPRESSIBLE_TYPES)
+        ):
+            content = gzip.compress(data, compresslevel=9, mtime=0)
+            if len(content) < len(data):
+                self.variants["gzip"] = _Variant(f'"{digest}-gzip"', content=content)
+
+    def pick(self, accept_encoding: str) -> tuple[str, _Variant]:
+        """Preferred variant accepted by the client"""
+        accepted = set()
+        for item in accept_encoding.split(","):
+            encoding, _, params = item.partition(";")
+            params = params.replace(" ", "")
+            try:
+                if params.startswith("q=") and float(params[2:]) == 0:
+                    continue  # Explicitly refused
+            except ValueError:
+                pass
+            accepted.add(encoding.strip().lower())
+        for encoding, _ in ENCODINGS:
+            if encoding in self.variants and (encoding in accepted or "*" in accepted):
+                return encoding, self.variants[encoding]
+        return "identity", self.variants["identity"]
+
+    def response(self, request: Request) -> Response:
+        encoding, variant = self.pick(request.headers.get("accept-encoding", ""))
+        headers = {
+            "ETag": variant.etag,
+            "Cache-Control": self.cache_control,
+            "Vary": "Accept-Encoding",
+        }
+        if_none_match = request.headers.get("if-none-match")
+        if if_none_match is not None:
+            tags = [tag.strip() for tag in if_none_match.split(",")]
+            if variant.etag in tags or "*" in tags:
+                return Response(status_code=304, headers=headers)
+
+        if encoding != "identity":
+            headers["Content-Encoding"] = encoding
+
+        if variant.content is not None:
+            return Response(
+                variant.content, media_type=self.media_type, headers=headers
+            )
+        return FileResponse(
+            variant.path,
+            media_type=self.media_type,
+            headers=headers,
+            stat_result=variant.stat,
+        )
+
+
+class StaticManifest:
+    """Index of the built frontend, read once at startup
+
+    Requests are answered from this index: a path that is not in it is a
+    route of the single page app and gets index.html, without touching the
+    filesystem.
+    """
+
+    def __init__(self):
+        self.assets: dict[str, StaticAsset] = {}
+
+    def load(self, root: Path) -> None:
+        assets = {}
+        if root.is_dir():
+            for path in sorted(root.rglob("*")):
+                if not path.is_file():
+                    continue
+                if path.suffix in (".br", ".gz") and path.with_suffix("").is_file():
+                    continue  # Variant of another file
+                relative = path.relative_to(root).as_posix()
+                assets[relative] = StaticAsset(path, relative)
+        self.assets = assets
+
+    def find(self, path: str) -> StaticAsset | None:
+        return self.assets.get(path.strip("/")) or self.assets.get("index.html")
+
+
+manifest = StaticManifest()
@@ -0,0 +1,166 @@
+import os
+import re
+import threading
+from datetime import datetime
+from typing import Callable
+
+TEMPLATE_DIR = os.path.join(os.path.dirname(__file__), "..", "templates")
+SHELL_TEMPLATE = "mail_shell"
+# Templates are reloaded when modified on disk, only meant for development
+DEV_MODE = os.getenv("DEV_MODE", "false").lower() in ("true", "1", "y", "yes")
+
+PLACEHOLDER = re.compile(r"\{([\w\-]+)\}")
+# Between the items of a digest mail
+DIGEST_SEPARATOR = (
+    '<hr style="border: none; border-top: 1px solid #ddf3fd; margin: 20px 0;">'
+)
+
+
+def d(value, format_type="date"):
+    dt = datetime.strptime(value, "%Y-%m-%d %H:%M")
+    if format_type == "date":
+        return dt.strftime("%d %B %Y")
+    elif format_type == "time":
+        return dt.strftime("%H:%M")
+    elif format_type == "datetime":
+        return dt.strftime("%d %B %Y %H:%M")
+    elif format_type == "long":
+        return dt.strftime("%A %d %B %Y %H:%M")
+    elif format_type == "short":
+        return dt.strftime("%d/%m/%Y %H:%M")
+    else:
+        return value
+
+
+def duration(value) -> str:
+    hours = int(value // 60)
+    minutes = value % 60
+    return (f"{hours}h" if hours > 0 else "") + (f"{minutes}min" if minutes > 0 else "")
+
+
+# Filters applied to a placeholder depending on its name, first match wins
+PREFIX_FILTERS: list[tuple[str, Callable[[object], str]]] = [
+    ("date-", lambda value: d(value)),
+    ("time-", lambda value: d(value, "time")),
+    ("datetime-", lambda value: d(value, "datetime")),
+    ("datetime_long-", lambda value: d(value, "long")),
+    ("datetime_short-", lambda value: d(value, "short")),
+]
+SUFFIX_FILTERS: list[tuple[str, Callable[[object], str]]] = [
+    ("duration", duration),
+]
+
+
+def filter_for(key: str) -> Callable[[object], str]:
+    for prefix, filter in PREFIX_FILTERS:
+        if key.startswith(prefix):
+            return filter
+    for suffix, filter in SUFFIX_FILTERS:
+        if key.endswith(suffix):
+            return filter
+    return str
+
+
+class Template:
+    """Template split once into literal text and placeholders
+
+    Placeholders missing from the values are left as is, like the previous
+    `str.replace` rendering did.
+    """
+
+    def __init__(self, source: str):
+        parts = PLACEHOLDER.split(source)
+        # Even parts are literal text, odd parts are placeholder names
+        self.literals: list[str] = parts[::2]
+        self.placeholders: list[tuple[str, Callable[[object], str]]] = [
+            (key, filter_for(key)) for key in parts[1::2]
+        ]
+
+    def render(self, values: dict, apply_filters: bool = True) -> str:
+        out = [self.literals[0]]
+        for (key, filter), literal in zip(self.placeholders, self.literals[1:]):
+            if key in values:
+                value = values[key]
+                out.append(filter(value) if apply_filters else str(value))
+            else:
+                out.append(f"{{{key}}}")
+            out.append(literal)
+        return "".join(out)
+
+
+class TemplateLoader:
+    """Loads every mail template once, already wrapped in the mail shell"""
+
+    def __init__(self, directory: str = TEMPLATE_DIR, reload: bool = DEV_MODE):
+        self.directory = directory
+        self.reload = reload
+        self._lock = threading.Lock()
+        self._templates: dict[str, Template] = {}
+        self._contents: dict[str, Template] = {}  # Without the mail shell
+        self._shell: Template | None = None
+        self._mtimes: dict[str, float] = {}
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name.replace(".", os.sep)) + ".html"
+
+    def _read(self, name: str) -> str:
+        with open(self._path(name), "r") as file:
+            return file.read()
+
+    def _compile(self, name: str) -> None:
+        shell, content = self._read(SHELL_TEMPLATE), self._read(name)
+        self._templates[name] = Template(shell.replace("{content}", content))
+        self._contents[name] = Template(content)
+        self._shell = Template(shell)
+        self._mtimes[name] = self._mtime(name)
+
+    def _mtime(self, name: str) -> float:
+        return max(
+            os.path.getmtime(self._path(name)),
+            os.path.getmtime(self._path(SHELL_TEMPLATE)),
+        )
+
+    def names(self) -> list[str]:
+        names = []
+        for root, _, files in os.walk(self.directory):
+            for file in files:
+                if not file.endswith(".html"):
+                    continue
+                path = os.path.relpath(os.path.join(root, file), self.directory)
+                names.append(path.removesuffix(".html").replace(os.sep, "."))
+        return [name for name in names if name != SHELL_TEMPLATE]
+
+    def load_all(self) -> None:
+        with self._lock:
+            for name in self.names():
+                self._compile(name)
+
+    def _ensure(self, name: str) -> None:
+        if name in self._templates and not self.reload:
+            return
+        with self._lock:
+            if name not in self._templates or self._mtimes[name] != self._mtime(name):
+                self._compile(name)
+
+    def get(self, name: str) -> Template:
+        self._ensure(name)
+        return self._templates[name]
+
+    def render(self, name: str, values: dict, apply_filters: bool = True) -> str:
+        return self.get(name).render(values, apply_filters)
+
+    def render_digest(self, items: list[tuple[str, dict]], values: dict) -> str:
+        """Render several templates in a single mail shell
+
+        `values` are shared by every item, and by the shell.
+        """
+        for name, _ in items:
+            self._ensure(name)
+        content = DIGEST_SEPARATOR.join(
+            self._contents[name].render({**item_values, **values})
+            for name, item_values in items
+        )
+        return self._shell.render({**values, "content": content})
+
+
+templates = TemplateLoader()
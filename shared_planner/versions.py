@@ -0,0 +1,119 @@
+import functools
+import hashlib
+import os
+import threading
+import time
+from collections.abc import Callable, Hashable, Iterable
+from typing import Any
+
+from fastapi import Request, Response
+from pydantic import TypeAdapter
+from sqlalchemy import event
+from sqlmodel import Session, select
+
+from shared_planner.cache import TTLCache
+from shared_planner.db.models import VERSION_KEY_PREFIX, Counter
+from shared_planner.db.session import SessionLock
+
+# Changes made by other workers are seen after at most this delay
+VERSION_REFRESH_INTERVAL = float(os.getenv("VERSION_REFRESH_INTERVAL", 1))  # Seconds
+# Versions set this long before the latest one seen are read again on refresh,
+# for the transactions that were still running when it was read
+VERSION_RELOAD_OVERLAP = 60 * 1000  # Milliseconds
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 2048))
+RESPONSE_CACHE_TTL = int(os.getenv("RESPONSE_CACHE_TTL", 300))  # Seconds
+
+
+class VersionMap:
+    """In-process copy of the VERSION_KEY_PREFIX counters
+
+    The copy is refreshed at most every VERSION_REFRESH_INTERVAL, reading only
+    the counters that changed recently (their value is a timestamp), and right
+    after this worker commits a change. In between, looking up versions does
+    not touch the database.
+    """
+
+    def __init__(self, interval: float = VERSION_REFRESH_INTERVAL):
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._versions: dict[str, int] = {}
+        self._since = 0  # Counters below this value are already known
+        self._expires = 0.0
+
+    def invalidate(self) -> None:
+        self._expires = 0.0
+
+    def _reload(self) -> None:
+        with SessionLock() as session:
+            rows = session.exec(
+                select(Counter.key, Counter.value).where(
+                    Counter.key.startswith(VERSION_KEY_PREFIX),
+                    Counter.value >= self._since,
+                )
+            ).all()
+        for key, value in rows:
+            self._versions[key] = value
+        if rows:
+            latest = max(value for _, value in rows)
+            self._since = max(self._since, latest - VERSION_RELOAD_OVERLAP)
+
+    def get(self, keys: Iterable[str]) -> tuple[int, ...]:
+        with self._lock:
+            if time.monotonic() >= self._expires:
+                self._reload()
+                self._expires = time.monotonic() + self.interval
+            return tuple(
+                self._versions.get(f"{VERSION_KEY_PREFIX}{key}", 0) for key in keys
+            )
+
+
+version_map = VersionMap()
+_responses: TTLCache[Hashable, tuple[str, bytes]] = TTLCache(
+    maxsize=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL
+)
+
+
+@event.listens_for(Session, "after_commit")
+def _refresh_after_commit(session: Session) -> None:
+    """Let this worker see its own changes on the next request"""
+    if session.info.pop("versions_changed", False):
+        version_map.invalidate()
+
+
+@functools.lru_cache
+def _adapter(model: Any) -> TypeAdapter:
+    return TypeAdapter(model)
+
+
+def cached_json(
+    request: Request,
+    key: Hashable,
+    version_keys: Iterable[str],
+    model: Any,
+    build: Callable[[], Any],
+) -> Response:
+    """Answer a GET with a JSON body that only changes with some version counters
+
+    `key` identifies the response (it must include the user when the body
+    depends on them) and `build` computes its content, serialized as `model`.
+    Clients sending back the current ETag get a 304, other requests are
+    served from the in-process cache until one of the versions changes.
+    """
+    versions = version_map.get(version_keys)
+    digest = hashlib.blake2b(repr((key, versions)).encode(), digest_size=12)
+    etag = f'"{digest.hexdigest()}"'
+    headers = {"ETag": etag, "Cache-Control": "private, no-cache"}
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        if etag in tags or "*" in tags:
+            return Response(status_code=304, headers=headers)
+
+    cached = _responses.get(key)
+    if cached is not None and cached[0] == etag:
+        body = cached[1]
+    else:
+        body = _adapter(model).dump_json(build())
+        _responses.set(key, (etag, body))
+    return Response(body, media_type="application/json", headers=headers)
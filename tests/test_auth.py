@@ -0,0 +1,65 @@
+"""Principal cache, see conftest.py for the PostgreSQL setup
+
+Each test changes the database behind the cache of this process, as another
+worker would, and checks that the next request sees the change.
+"""
+
+import pytest
+from fastapi import HTTPException
+from sqlmodel import Session, select
+
+from shared_planner.api import auth
+from shared_planner.api.auth import CurrentAdmin, CurrentUser, logout
+from shared_planner.db import settings
+from shared_planner.db.models import Token, User
+
+
+@pytest.fixture
+def admin_token(app_engine) -> str:
+    settings.init_settings()
+    settings.cache.invalidate()
+    with Session(app_engine) as session:
+        user = User(full_name="Admin", email="admin@example.com", group="", admin=True)
+        token = Token.create_token(user)
+        session.add(token)
+        session.commit()
+        return token.access_token
+
+
+def test_demoted_admins_lose_access(app_engine, admin_token):
+    assert CurrentAdmin(CurrentUser(admin_token)).admin
+
+    with Session(app_engine) as session:
+        user = session.exec(select(User)).one()
+        user.admin = False
+        session.commit()
+
+    with pytest.raises(HTTPException) as error:
+        CurrentAdmin(CurrentUser(admin_token))
+    assert error.value.status_code == 403
+
+
+def test_deleted_users_lose_access(app_engine, admin_token):
+    CurrentUser(admin_token)
+
+    with Session(app_engine) as session:
+        session.delete(session.exec(select(User)).one())
+        session.commit()
+
+    with pytest.raises(HTTPException) as error:
+        CurrentUser(admin_token)
+    assert error.value.status_code == 401
+
+
+def test_logged_out_tokens_are_rejected(app_engine, admin_token):
+    CurrentUser(admin_token)
+    cached = auth._principals.get(admin_token)
+
+    with Session(app_engine) as session:
+        token = session.exec(select(Token)).one()
+    logout(token)
+    auth._principals.set(admin_token, cached)  # Still cached by other workers
+
+    with pytest.raises(HTTPException) as error:
+        CurrentUser(admin_token)
+    assert error.value.status_code == 401
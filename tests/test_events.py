@@ -0,0 +1,88 @@
+"""Event broker, see conftest.py for the PostgreSQL setup"""
+
+import asyncio
+import datetime
+import json
+
+import pytest
+from sqlmodel import Session
+
+from shared_planner.db.models import Event
+from shared_planner.events import EventBroker
+
+
+def _insert(engine, id: int) -> None:
+    with engine.begin() as connection:
+        connection.execute(
+            Event.__table__.insert().values(
+                id=id,
+                channel="user:1",
+                type="unread",
+                data=json.dumps({"id": id}),
+                date=datetime.datetime.now(),
+            )
+        )
+
+
+def _received(subscription) -> list[int]:
+    received = []
+    while not subscription.queue.empty():
+        _, data = subscription.queue.get_nowait()
+        received.append(json.loads(data)["id"])
+    return received
+
+
+def test_events_are_delivered_once_from_the_mark(app_engine):
+    async def scenario():
+        broker = EventBroker()
+        _insert(app_engine, 1)
+        subscription = broker.subscribe(["user:1", "user:2"], 1)
+        await broker._poll()
+        assert _received(subscription) == []
+
+        _insert(app_engine, 2)
+        _insert(app_engine, 3)
+        await broker._poll()
+        await broker._poll()
+        assert _received(subscription) == [2, 3]
+
+    asyncio.run(scenario())
+
+
+def test_events_committed_out_of_order_are_delivered(app_engine):
+    async def scenario():
+        broker = EventBroker()
+        subscription = broker.subscribe(["user:1"], 0)
+        _insert(app_engine, 2)  # The transaction given id 1 is still running
+        await broker._poll()
+        assert _received(subscription) == [2]
+
+        _insert(app_engine, 1)
+        _insert(app_engine, 3)
+        await broker._poll()
+        await broker._poll()
+        assert _received(subscription) == [1, 3]
+
+    asyncio.run(scenario())
+
+
+def test_concurrent_transactions_commit_out_of_order(app_engine):
+    if app_engine.dialect.name != "postgresql":
+        pytest.skip("SQLite runs one writer at a time")
+
+    async def scenario():
+        broker = EventBroker()
+        subscription = broker.subscribe(["user:1"], 0)
+        with Session(app_engine) as slow, Session(app_engine) as fast:
+            Event.publish(slow, "user:1", "unread", {"id": "slow"})
+            slow.flush()
+            Event.publish(fast, "user:1", "unread", {"id": "fast"})
+            fast.commit()
+            await broker._poll()
+            assert _received(subscription) == ["fast"]
+
+            slow.commit()
+        await broker._poll()
+        assert _received(subscription) == ["slow"]
+
+    asyncio.run(scenario())
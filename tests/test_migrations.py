@@ -0,0 +1,152 @@
+"""Migration runner, see conftest.py for the PostgreSQL setup"""
+
+import datetime
+import threading
+import time
+
+import pytest
+from sqlalchemy import (
+    Boolean,
+    Column,
+    DateTime,
+    ForeignKey,
+    Integer,
+    LargeBinary,
+    MetaData,
+    String,
+    Table,
+    create_engine,
+    inspect,
+)
+from sqlmodel import Session, select
+
+from shared_planner.db.migrations import MIGRATIONS, current_version, run_migrations
+from shared_planner.db.models import Counter, MailOutbox, SchemaVersion
+
+# Tables of a database created before the migrations existed
+legacy = MetaData()
+legacy_user = Table(
+    "user",
+    legacy,
+    Column("id", Integer, primary_key=True),
+    Column("full_name", String, nullable=False),
+    Column("email", String, nullable=False, unique=True),
+    Column("hashed_password", LargeBinary, nullable=False, default=b""),
+    Column("admin", Boolean, nullable=False),
+    Column("group", String, nullable=False, default=""),
+)
+legacy_notification = Table(
+    "notification",
+    legacy,
+    Column("id", Integer, primary_key=True),
+    Column("user_id", Integer, ForeignKey("user.id"), nullable=True),
+    Column("message", String, nullable=False),
+    Column("date", DateTime, nullable=False, default=datetime.datetime.now),
+    Column("data", String, nullable=True, default="{}"),
+    Column("is_reminder", Boolean, nullable=False, default=False),
+    Column("read", Boolean, nullable=False, default=False),
+    Column("route", String, nullable=True),
+    Column("mail", Boolean, nullable=False, default=True),
+    Column("mail_sent", Boolean, nullable=False, default=False),
+)
+
+# Counter table of the releases before its values held timestamps
+legacy_counters = MetaData()
+legacy_counter = Table(
+    "counter",
+    legacy_counters,
+    Column("key", String, primary_key=True),
+    Column("value", Integer, nullable=False),
+)
+
+
+@pytest.fixture
+def legacy_engine(engine):
+    """Database of the first release: an admin, a user and two unsent mails"""
+    legacy.create_all(engine)
+    with engine.begin() as connection:
+        connection.execute(
+            legacy_user.insert(),
+            [
+                dict(id=1, full_name="Admin", email="admin@example.com", admin=True),
+                dict(id=2, full_name="User", email="user@example.com", admin=False),
+            ],
+        )
+        connection.execute(
+            legacy_notification.insert(),
+            [
+                dict(user_id=2, message="notification.reservation_created"),
+                dict(user_id=None, message="notification.admin.reservation_created"),
+            ],
+        )
+    return engine
+
+
+def _versions(engine) -> list[int]:
+    with Session(engine) as session:
+        return sorted(session.exec(select(SchemaVersion.version)).all())
+
+
+def _outbox(engine) -> list[tuple[str, str]]:
+    with Session(engine) as session:
+        return sorted(session.exec(select(MailOutbox.email, MailOutbox.template)).all())
+
+
+def test_new_database_records_every_migration(engine):
+    run_migrations(engine)
+    run_migrations(engine)
+
+    assert _versions(engine) == list(range(1, len(MIGRATIONS) + 1))
+    assert _outbox(engine) == []
+
+
+def test_legacy_database_is_upgraded(legacy_engine):
+    run_migrations(legacy_engine)
+
+    with legacy_engine.connect() as connection:
+        assert current_version(connection) == len(MIGRATIONS)
+    columns = [c["name"] for c in inspect(legacy_engine).get_columns("user")]
+    assert "calendar_token" in columns
+    # Pending mails of the former in-memory queue are moved to the outbox
+    assert _outbox(legacy_engine) == [
+        ("admin@example.com", "notification.admin.reservation_created"),
+        ("user@example.com", "notification.reservation_created"),
+    ]
+
+
+def test_concurrent_starts_migrate_once(legacy_engine, database_url):
+    workers = 4
+    barrier = threading.Barrier(workers)
+    errors = []
+
+    def start():
+        # One engine each, like separate workers or nodes
+        engine = create_engine(database_url)
+        barrier.wait()
+        try:
+            run_migrations(engine)
+        except Exception as e:
+            errors.append(e)
+        finally:
+            engine.dispose()
+
+    threads = [threading.Thread(target=start) for _ in range(workers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert _versions(legacy_engine) == list(range(1, len(MIGRATIONS) + 1))
+    assert len(_outbox(legacy_engine)) == 2  # Not queued once per worker
+
+
+def test_counters_hold_timestamps(engine):
+    legacy_counters.create_all(engine)
+    run_migrations(engine)
+
+    now = int(time.time() * 1000)
+    with Session(engine) as session:
+        Counter.advance(session, "version:shops", now)
+        session.commit()
+        assert Counter.read(session, "version:shops") >= now
@@ -0,0 +1,71 @@
+"""Read states of the admin notifications, see conftest.py for the PostgreSQL setup"""
+
+import datetime
+
+import pytest
+from sqlmodel import Session, func, select
+
+from shared_planner.db.migrations import run_migrations
+from shared_planner.db.models import Notification, NotificationRead, User
+
+
+@pytest.fixture
+def session(engine):
+    """Migrated database with two admins who read an admin notification"""
+    run_migrations(engine)
+    with Session(engine) as session:
+        admins = [
+            User(
+                full_name=f"Admin {i}",
+                email=f"admin{i}@example.com",
+                admin=True,
+                group="",
+            )
+            for i in range(2)
+        ]
+        session.add_all(admins)
+        session.add_all(
+            Notification(
+                user_id=None,
+                message="notification.admin.reservation_created",
+                date=datetime.datetime.now() - datetime.timedelta(days=days),
+            )
+            for days in (0, 30)
+        )
+        session.commit()
+        for admin in admins:
+            NotificationRead.mark(session, admin.id)
+        session.commit()
+        yield session
+
+
+def _admins(session: Session) -> list[User]:
+    return session.exec(select(User).order_by(User.id)).all()
+
+
+def _reads(session: Session) -> int:
+    return session.exec(select(func.count()).select_from(NotificationRead)).one()
+
+
+def test_deleting_a_read_admin_notification(session):
+    notification = session.exec(select(Notification)).first()
+    session.delete(notification)
+    session.commit()
+
+    assert _reads(session) == 2
+    for admin in _admins(session):
+        assert Notification.count_unread(admin, session) == 0
+
+
+def test_bulk_deleting_read_admin_notifications(session):
+    deleted = Notification.delete_where(
+        session,
+        Notification.date < datetime.datetime.now() - datetime.timedelta(days=7),
+    )
+    Notification.recount_unread(session)
+    session.commit()
+
+    assert deleted == 1
+    assert _reads(session) == 2
+    for admin in _admins(session):
+        assert Notification.count_unread(admin, session) == 0
@@ -0,0 +1,96 @@
+"""Reminder schedule of the mailer, see conftest.py for the PostgreSQL setup"""
+
+import datetime
+
+import pytest
+from sqlmodel import Session
+
+from shared_planner.db.migrations import run_migrations
+from shared_planner.db.models import Reservation, Shop, User
+from shared_planner.reminders import ReminderSchedule
+
+HOURS_BEFORE = 2
+
+
+@pytest.fixture
+def session(engine):
+    """Migrated database with a shop and a user"""
+    run_migrations(engine)
+    with Session(engine) as session:
+        now = datetime.datetime.now()
+        session.add(
+            Shop(
+                name="Shop",
+                location="",
+                maps_link="",
+                description="",
+                min_time=0,
+                max_time=24 * 60,
+                available_from=now,
+                available_until=now + datetime.timedelta(days=7),
+            )
+        )
+        session.add(User(full_name="User", email="user@example.com", group=""))
+        session.commit()
+        yield session
+
+
+def _book(session: Session, start_time: datetime.datetime) -> int:
+    reservation = Reservation(
+        user_id=1,
+        shop_id=1,
+        start_time=start_time,
+        end_time=start_time + datetime.timedelta(hours=1),
+    )
+    session.add(reservation)
+    session.commit()
+    return reservation.id
+
+
+def _tick(schedule: ReminderSchedule, session: Session, now: datetime.datetime):
+    schedule.refresh(session, HOURS_BEFORE, now)
+    session.commit()
+    return schedule.due(now)
+
+
+def test_due_reminders_stay_until_done(session):
+    now = datetime.datetime.now()
+    id = _book(session, now + datetime.timedelta(hours=1))
+    schedule = ReminderSchedule()
+
+    # Queuing them failed, e.g. the database was locked
+    assert _tick(schedule, session, now) == [id]
+    assert _tick(schedule, session, now) == [id]
+
+    schedule.done([id])
+    assert _tick(schedule, session, now) == []
+
+
+def test_bookings_and_moves_update_the_schedule(session, monkeypatch):
+    now = datetime.datetime.now()
+    later = now + datetime.timedelta(hours=5)
+    schedule = ReminderSchedule()
+    assert _tick(schedule, session, now) == []
+
+    reloads = []
+    monkeypatch.setattr(
+        Reservation,
+        "upcoming_reminders",
+        lambda *args: reloads.append(args) or [],
+    )
+    id = _book(session, later)
+    assert _tick(schedule, session, now) == []
+    assert schedule.next_due() == later - datetime.timedelta(hours=HOURS_BEFORE)
+
+    reservation = session.get(Reservation, id)
+    reservation.start_time = now + datetime.timedelta(hours=1)
+    session.add(reservation)
+    session.commit()
+    assert _tick(schedule, session, now) == [id]
+
+    reservation.start_time = now + datetime.timedelta(days=3)  # Past the horizon
+    session.add(reservation)
+    session.commit()
+    assert _tick(schedule, session, now) == []
+    assert schedule.next_due() is None
+    assert reloads == []
@@ -0,0 +1,20 @@
+import { api } from ".";
+
+export default class CalendarApi {
+    async token(): Promise<string> {
+        const result = await api.get('/calendar/token');
+        return result.data;
+    }
+
+    async resetToken(): Promise<string> {
+        const result = await api.post('/calendar/token/reset');
+        return result.data;
+    }
+
+    // webcal:// makes the browser hand the feed to the calendar application
+    feedUrl(token: string, shop_id?: number): string {
+        const path = shop_id === undefined ? 'reservations.ics' : `shop/${shop_id}.ics`;
+        const url = new URL(`${api.defaults.baseURL}/calendar/${token}/${path}`, window.location.href);
+        return url.href.replace(/^https?:/, 'webcal:');
+    }
+}
@@ -0,0 +1,22 @@
+import { api } from ".";
+
+type EventHandlers = { [type: string]: (data: any) => void };
+
+/**
+ * Listen to the server events of the current user (and of some shops).
+ * The browser reconnects by itself, close the returned source when done.
+ */
+export function subscribe(handlers: EventHandlers, shopIds: number[] = []): EventSource | null {
+    const token = localStorage.getItem("access_token");
+    if (token === null) {
+        return null;
+    }
+    const params = new URLSearchParams({ token });
+    shopIds.forEach((id) => params.append("shop_id", id.toString()));
+
+    const source = new EventSource(`${api.defaults.baseURL}/events?${params}`);
+    for (const [type, handler] of Object.entries(handlers)) {
+        source.addEventListener(type, (event) => handler(JSON.parse((event as MessageEvent).data)));
+    }
+    return source;
+}
@@ -1,5 +1,5 @@
 import { api } from ".";
-import type { Notification } from "./types";
+import type { Notification, NotificationBatchAction, NotificationBulkResult, NotificationPage } from "./types";
 
 export default class NotificationsApi {
 
@@ -9,13 +9,13 @@ export default class NotificationsApi {
         return result.data;
     }
 
-    async list(): Promise<Notification[]> {
-        const result = await api.get(`/notifications/list`);
+    async list(page: NotificationPage = {}): Promise<Notification[]> {
+        const result = await api.get(`/notifications/list`, { params: page });
         return result.data;
     }
 
-    async list_unread(): Promise<Notification[]> {
-        const result = await api.get(`/notifications/unread`);
+    async list_unread(page: NotificationPage = {}): Promise<Notification[]> {
+        const result = await api.get(`/notifications/unread`, { params: page });
         return result.data;
     }
 
@@ -23,8 +23,13 @@ export default class NotificationsApi {
         await api.delete(`/notifications/id/${id}`);
     }
 
-    async delete_all(): Promise<Notification[]> {
-        const result = await api.delete(`/notifications/all`);
+    async delete_all(page?: NotificationPage): Promise<NotificationBulkResult> {
+        const result = await api.delete(`/notifications/all`, { params: { include_page: page !== undefined, ...page } });
+        return result.data;
+    }
+
+    async batch(ids: number[], action: NotificationBatchAction, page?: NotificationPage): Promise<NotificationBulkResult> {
+        const result = await api.post(`/notifications/batch`, { ids, action }, { params: { include_page: page !== undefined, ...page } });
         return result.data;
     }
 
@@ -33,8 +38,8 @@ export default class NotificationsApi {
         return result.data;
     }
 
-    async mark_all_as_read(): Promise<Notification[]> {
-        const result = await api.patch(`/notifications/all/read`);
+    async mark_all_as_read(page?: NotificationPage): Promise<NotificationBulkResult> {
+        const result = await api.patch(`/notifications/all/read`, null, { params: { include_page: page !== undefined, ...page } });
         return result.data;
     }
 
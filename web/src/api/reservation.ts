@@ -1,5 +1,5 @@
 import { api } from ".";
-import type { BookSlotRequest, BookMultipleSlotsRequest, ReservedTimeRange, SlotStatus } from "./types";
+import type { BookSlotRequest, BookMultipleSlotsRequest, ReservationSearch, ReservedTimeRange, SlotStatus } from "./types";
 
 export default class ReservationApi {
     async getPlanning(shopId: number, monday: string): Promise<SlotStatus[][]> {
@@ -34,12 +34,14 @@ export default class ReservationApi {
         return result.data;
     }
 
-    async myReservations(): Promise<ReservedTimeRange[]> {
-        const result = await api.get(`/res/list_self_future`);
+    async myReservations(after?: ReservedTimeRange, limit?: number): Promise<ReservedTimeRange[]> {
+        const result = await api.get(`/res/list_self_future`, {
+            params: { after_start_time: after?.start_time, after_id: after?.id, limit }
+        });
         return result.data;
     }
 
-    async search(search: { shop_id: number | undefined, monday: string | undefined, user_id: number | undefined }): Promise<ReservedTimeRange[]> {
+    async search(search: ReservationSearch): Promise<ReservedTimeRange[]> {
         const result = await api.post(`/res/search`, search);
         return result.data;
     }
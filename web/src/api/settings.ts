@@ -23,6 +23,8 @@ export default class SettingsApi {
         deleted_reminders: number;
         deleted_notifications: number;
         deleted_notifications_admin: number;
+        deleted_mails: number;
+        deleted_events: number;
     }> {
         const result = await api.post('/settings/cleanup_db');
         return result.data;
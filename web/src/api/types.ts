@@ -126,6 +126,17 @@ type BookRangeRequest = {
     start_time: string,
     duration_minutes: number
 }
+
+type ReservationSearch = {
+    shop_id?: number,
+    user_id?: number,
+    monday?: string,
+    start?: string,         // "YYYY-MM-DD"
+    end?: string,           // "YYYY-MM-DD"
+    after_start_time?: string,
+    after_id?: number,
+    limit?: number
+}
 type Setting = {
     key: string,
     value: string,
@@ -147,6 +158,19 @@ type Notification = {
     mail_sent: boolean,
 }
 
+type NotificationPage = {
+    before_date?: string,
+    before_id?: number,
+    limit?: number
+}
+
+type NotificationBulkResult = {
+    count: number,
+    notifications: Notification[] | null
+}
+
+type NotificationBatchAction = "read" | "unread" | "delete"
+
 const exampleNotification: Notification = {
     id: -1,
     user_id: null,
@@ -164,5 +188,5 @@ const exampleNotification: Notification = {
 
 
 
-export type { TokenResponse, User, Shop, OpenRange, ShopWithOpenRange, ReservedTimeRange, TimeSlot, SlotStatus, BookSlotRequest, BookRangeRequest, Setting, Notification }
+export type { TokenResponse, User, Shop, OpenRange, ShopWithOpenRange, ReservedTimeRange, TimeSlot, SlotStatus, BookSlotRequest, BookRangeRequest, ReservationSearch, Setting, Notification, NotificationPage, NotificationBulkResult, NotificationBatchAction }
 export { exampleShop, exampleReservedTimeRange, exampleOpenRange, exampleShopWithOpenRange, exampleUser, exampleNotification }
\ No newline at end of file
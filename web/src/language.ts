@@ -99,6 +99,8 @@ const messages = {
         new_reservation_explanation:
           "Click the button below to show the available shops, then click the 'Book' button to create a reservation in the shop of your choice.",
         new_reservation_button: "Click here to see the shops and book a time",
+        subscribe_calendar: "Add my reservations to my calendar",
+        load_more: "Load more",
         booked: "Booked",
         booked_by_you: "Booked by you",
         full: "Full",
@@ -195,7 +197,7 @@ const messages = {
         saved_title: "Setting saved",
 
         optimized_description:
-          "The database has been optimized :\n{deleted_tokens} login tokens\n{deleted_password_resets} password reset tokens\n{deleted_reminders} reminders\n{deleted_notifications} notifications\n{deleted_notifications_admin} admin notifications",
+          "The database has been optimized :\n{deleted_tokens} login tokens\n{deleted_password_resets} password reset tokens\n{deleted_reminders} reminders\n{deleted_notifications} notifications\n{deleted_notifications_admin} admin notifications\n{deleted_mails} sent mails\n{deleted_events} live update events",
         optimized_title: "Database optimized",
         key: "Setting",
         value: "Value",
@@ -299,6 +301,7 @@ const messages = {
         select_shop: "Select a shop",
         filter_no_shop_found: "No shops found",
         no_reservations: "No reservations found",
+        load_more: "Load more",
       },
     },
     day: {
@@ -354,6 +357,10 @@ const messages = {
         no_id: "No shop id provided",
         unknown: "An unknown error happened while trying to get the shop data.",
       },
+      calendar: {
+        not_found: "Calendar not found",
+        unknown: "An unknown error happened while trying to get the calendar link.",
+      },
       reservation: {
         overlap: "This slot is full",
         not_found: "Reservation not found",
@@ -417,6 +424,7 @@ const messages = {
       delete_all_confirm:
         "Are you sure you want to delete all notifications ?\nThis action cannot be undone.",
       all_deleted: "All notifications have been deleted.",
+      load_more: "Load more",
       cancel: "Cancel",
       success: "Success",
 
@@ -533,6 +541,8 @@ const messages = {
           "Cliquez sur le bouton ci-dessous pour afficher les magasins disponibles, puis cliquez sur le bouton 'Réserver' pour créer une réservation dans le magasin de votre choix.",
         new_reservation_button:
           "Cliquez ici pour voir les magasins et réserver un créneau",
+        subscribe_calendar: "Ajouter mes réservations à mon agenda",
+        load_more: "Afficher plus",
         booked: "Réservé",
         booked_by_you: "Réservé par vous",
         full: "Complet",
@@ -628,7 +638,7 @@ const messages = {
         saved_description: "{key} a été sauvegardé avec succès.",
         saved_title: "Paramètre sauvegardé",
         optimized_description:
-          "La base de données a été optimisée :\n{deleted_tokens} jetons de connexion\n{deleted_password_resets} jetons de réinitialisation de mot de passe\n{deleted_reminders} rappels\n{deleted_notifications} notifications\n{deleted_notifications_admin} notifications admin",
+          "La base de données a été optimisée :\n{deleted_tokens} jetons de connexion\n{deleted_password_resets} jetons de réinitialisation de mot de passe\n{deleted_reminders} rappels\n{deleted_notifications} notifications\n{deleted_notifications_admin} notifications admin\n{deleted_mails} mails envoyés\n{deleted_events} événements de mise à jour en direct",
         key: "Paramètre",
         value: "Valeur",
 
@@ -741,6 +751,7 @@ const messages = {
         select_shop: "Sélectionnez un magasin",
         filter_no_shop_found: "Aucun magasin trouvée",
         no_reservations: "Aucune réservation trouvée",
+        load_more: "Afficher plus",
       },
     },
     day: {
@@ -800,6 +811,11 @@ const messages = {
         unknown:
           "Une erreur inconnue est survenue lors de la récupération des données de le magasin.",
       },
+      calendar: {
+        not_found: "Agenda introuvable",
+        unknown:
+          "Une erreur inconnue est survenue lors de la récupération du lien de l'agenda.",
+      },
       reservation: {
         overlap: "Ce créneau est complet",
         not_found: "Réservation introuvable",
@@ -869,6 +885,7 @@ const messages = {
       delete_all_confirm:
         "Êtes-vous sûr de vouloir supprimer toutes les notifications ?\nCette action est irréversible.",
       all_deleted: "Toutes les notifications ont été supprimées.",
+      load_more: "Afficher plus",
       cancel: "Annuler",
       success: "Succès",
 
@@ -20,6 +20,7 @@ import SlotsApi from './api/slots';
 import UsersApi from './api/users';
 import SettingsApi from './api/settings';
 import NotificationsApi from './api/notifications';
+import CalendarApi from './api/calendar';
 
 
 
@@ -63,5 +64,6 @@ const slotsApi: SlotsApi = new SlotsApi();
 const usersApi: UsersApi = new UsersApi();
 const settingsApi: SettingsApi = new SettingsApi();
 const notificationsApi = new NotificationsApi();
+const calendarApi = new CalendarApi();
 
-export { authApi, shopApi, reservationApi, slotsApi, usersApi, settingsApi, notificationsApi };
+export { authApi, shopApi, reservationApi, slotsApi, usersApi, settingsApi, notificationsApi, calendarApi };